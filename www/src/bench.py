@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+'''
+Benchmarks for the db, orm and web layers.
+
+    python bench.py <name> [args...]
+
+The db benchmarks need the myblog database from createtable.sql.
+'''
+
+import logging
+logging.basicConfig(format='%(levelname)s:%(message)s',level='WARNING')
+import sys,time
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+import db
+
+def _engine():
+    if db.engine is None:
+        db.create_engine(user='root',password='123456',database='myblog')
+
+def _timeit(func,*args):
+    #db._update prints every statement, keep it off the terminal
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        start = time.time()
+        r = func(*args)
+        return time.time() - start, r
+    finally:
+        sys.stdout = stdout
+
+def _report(name,n,t):
+    print '%-32s %8d in %8.3fs  %12.1f/s' % (name,n,t,n / t if t else 0.0)
+
+def _bench_users(prefix,n):
+    return [dict(id=db.next_id(),email='%s-%d@bench.org' % (prefix,i),password='bench',admin=False,
+                 name='bench%d' % i,image='about:blank',created_at=time.time()) for i in range(n)]
+
+def _cleanup_users():
+    _timeit(db.update,'delete from users where email like ?','%@bench.org')
+
+def bench_insert_many(n=2000):
+    '''
+    insert() in a loop against insert_many() for n users.
+    '''
+    n = int(n)
+    _engine()
+    _cleanup_users()
+    rows = _bench_users('loop',n)
+    def loop():
+        for row in rows:
+            db.insert('users',**row)
+    t,r = _timeit(loop)
+    _report('insert() loop',n,t)
+    t,r = _timeit(db.insert_many,'users',_bench_users('many',n))
+    _report('insert_many()',r,t)
+    _cleanup_users()
+
+def _sizeof_rows(rows):
+    #the values themselves are shared, count only the per row containers
+    n = 0
+    for r in rows:
+        n = n + sys.getsizeof(r)
+        if isinstance(r,db.Row):
+            n = n + sys.getsizeof(r._values)
+    return n
+
+def bench_rows(n=100000):
+    '''
+    Dict rows against Row rows for n records of the users table.
+    '''
+    n = int(n)
+    names = ['id','email','password','admin','name','image','created_at']
+    records = [(db.next_id(),'u%d@test.org' % i,'secret',0,'user%d' % i,'about:blank',time.time()) for i in range(n)]
+    def dict_rows():
+        return [db.Dict(names,x) for x in records]
+    def compact_rows():
+        schema = db._Schema(names)
+        return [db.Row(schema,x) for x in records]
+    for label,build in (('Dict rows',dict_rows),('Row rows',compact_rows)):
+        t,rows = _timeit(build)
+        _report('build %s' % label,n,t)
+        t,r = _timeit(lambda: [x.name for x in rows])
+        _report('x.name on %s' % label,n,t)
+        print '%-32s %8.1f bytes/row' % ('memory of %s' % label,float(_sizeof_rows(rows)) / n)
+
+def _uuid_id(t=None):
+    #the ids db.next_id() made before: milliseconds and uuid4, 50 chars
+    import uuid
+    return '%015d%s000' % (int((t or time.time()) * 1000), uuid.uuid4().hex)
+
+def bench_next_id(n=200000):
+    '''
+    Generation rate of the old uuid ids against next_id()/next_int_id(),
+    then insert throughput of n users keyed by each of them.
+    '''
+    n = int(n)
+    for label,gen in (('uuid ids',_uuid_id),('next_id()',db.next_id),('next_int_id()',db.next_int_id)):
+        t,r = _timeit(lambda: [gen() for i in xrange(n)])
+        _report('generate %s' % label,n,t)
+    _engine()
+    for label,gen in (('uuid ids',_uuid_id),('next_id()',db.next_id)):
+        _cleanup_users()
+        rows = _bench_users('id',n)
+        for row in rows:
+            row['id'] = gen()
+        t,r = _timeit(db.insert_many,'users',rows)
+        _report('insert_many() with %s' % label,r,t)
+    _cleanup_users()
+
+def _legacy_insert(m):
+    #Model.insert() before the statements were compiled per class
+    params = {}
+    for key,value in m.__mappings__.iteritems():
+        if value.insertable:
+            if not hasattr(m,key):
+                setattr(m,key,value.default)
+            params[value.name] = getattr(m,key)
+    db.insert('%s' % m.__table__,**params)
+
+def _legacy_update(m):
+    #Model.update() before the statements were compiled per class
+    items = []
+    args = []
+    for key,value in m.__mappings__.iteritems():
+        if value.updatable:
+            items.append('%s = ?' % key)
+            args.append(getattr(m,key))
+    pk = m.__primary_key__.name
+    args.append(getattr(m,pk))
+    db.update('update `%s` set %s where %s = ?' % (m.__table__,','.join(items),pk),*args)
+
+def bench_orm_write(n=100000):
+    '''
+    Python side cost of Model.insert()/update() before and after the
+    statements were compiled per class, with the db calls stubbed out.
+    '''
+    n = int(n)
+    from model import User
+    update, _update = db.update, db._update
+    db.update = db._update = lambda sql,*args: 1
+    try:
+        users = [User(id=db.next_id(),email='u%d@bench.org' % i,password='bench',admin=False,
+                      name='bench%d' % i,image='about:blank',created_at=time.time()) for i in xrange(n)]
+        t,r = _timeit(lambda: [_legacy_insert(u) for u in users])
+        _report('insert() before',n,t)
+        t,r = _timeit(lambda: [u.insert() for u in users])
+        _report('insert() compiled',n,t)
+        for u in users:
+            u._set_loaded(None)
+        t,r = _timeit(lambda: [_legacy_update(u) for u in users])
+        _report('update() before',n,t)
+        t,r = _timeit(lambda: [u.update() for u in users])
+        _report('update() compiled',n,t)
+    finally:
+        db.update, db._update = update, _update
+
+def _sizeof_models(objs):
+    import orm
+    n = 0
+    for o in objs:
+        n = n + sys.getsizeof(o)
+        if not isinstance(o,orm.SlotModel):
+            if vars(o):
+                n = n + sys.getsizeof(vars(o))
+            #read the slot as stored, _get_loaded() would build the dict
+            n = n + sys.getsizeof(object.__getattribute__(o,'_loaded'))
+    return n
+
+def bench_hydrate(n=100000):
+    '''
+    Hydration of n comments: Dict rows into Model, Row rows into Model
+    and Row rows into a SlotModel, with the memory kept per instance.
+    '''
+    n = int(n)
+    import orm
+    from model import Comment
+    class CompactComment(orm.SlotModel):
+        __table__ = 'comments'
+        id = orm.StringField(primary_key=True,ddl='varchar(50)')
+        blog_id = orm.StringField(updatable=False,ddl='varchar(50)')
+        user_id = orm.StringField(updatable=False,ddl='varchar(50)')
+        user_name = orm.StringField(ddl='varchar(50)')
+        user_image = orm.StringField(ddl='varchar(500)')
+        content = orm.TextField()
+        created_at = orm.FloatField(updatable=False)
+    names = ['id','blog_id','user_id','user_name','user_image','content','created_at']
+    schema = db._Schema(names)
+    records = [(db.next_id(),'b%d' % (i % 100),'u%d' % (i % 1000),'user','about:blank','comment %d' % i,time.time()) for i in xrange(n)]
+    dict_rows = [db.Dict(names,x) for x in records]
+    rows = [db.Row(schema,x) for x in records]
+    for label,cls,source in (('Dict rows -> Model',Comment,dict_rows),('Row rows -> Model',Comment,rows),('Row rows -> SlotModel',CompactComment,rows)):
+        t,objs = _timeit(lambda: [cls._hydrate(d) for d in source])
+        _report(label,n,t)
+        t,r = _timeit(lambda: [o.content for o in objs])
+        _report('  .content',n,t)
+        print '%-32s %8.1f bytes/instance' % ('  memory',float(_sizeof_models(objs)) / n)
+
+def _posts(n):
+    #synthetic posts: english words and runs of common CJK characters
+    import random
+    rnd = random.Random(42)
+    words = ['w%d' % i for i in xrange(20000)]
+    chars = [unichr(0x4e00 + i) for i in xrange(3000)]
+    def text(k):
+        parts = []
+        for i in xrange(k):
+            if rnd.random() < 0.5:
+                parts.append(words[int(rnd.paretovariate(1.2)) % len(words)])
+            else:
+                parts.append(u''.join([chars[int(rnd.paretovariate(1.2)) % len(chars)] for j in xrange(4)]))
+        return u' '.join(parts)
+    for i in xrange(n):
+        yield '%016x' % i,dict(name=text(3),summary=text(8),content=text(40))
+
+def bench_search(n=1000000,queries=200):
+    '''
+    Build the blog search index over n synthetic posts, then time top 10
+    queries, save() and load().
+    '''
+    n,queries = int(n),int(queries)
+    import os,random,tempfile
+    import search
+    index = search.SearchIndex(search.blogs.fields)
+    #generate the posts in chunks, timing only the indexing
+    posts = _posts(n)
+    total = 0.0
+    for i in xrange(0,n,10000):
+        chunk = [next(posts) for j in xrange(min(10000,n - i))]
+        t,r = _timeit(lambda: [index.add(d,doc) for d,doc in chunk])
+        total = total + t
+    _report('index posts',n,total)
+    rnd = random.Random(7)
+    terms = sorted(index._postings)
+    qs = [u' '.join(rnd.sample(terms,2)) for i in xrange(queries)]
+    t,r = _timeit(lambda: [index.search(q,10) for q in qs])
+    _report('top 10 queries',queries,t)
+    path = os.path.join(tempfile.gettempdir(),'bench_search.idx')
+    t,r = _timeit(index.save,path)
+    _report('save()',n,t)
+    print '%-32s %8.1f MB, %.1f bytes/post' % ('index file',os.path.getsize(path) / 1048576.0,float(os.path.getsize(path)) / n)
+    t,r = _timeit(search.SearchIndex(search.blogs.fields).load,path)
+    _report('load()',n,t)
+    os.remove(path)
+
+def bench_router(n=500,lookups=100000):
+    '''
+    Route lookups over n routes, half static and half with parameters:
+    the linear scan over compiled regexes the application used before
+    against the route tree, for the first, the last and a static file.
+    '''
+    n,lookups = int(n),int(lookups)
+    import web
+    routes = []
+    for i in xrange(n):
+        path = '/api/r%d/:id/items/:item' % i if i % 2 else '/api/r%d/list' % i
+        routes.append(web.Route(web.get(path)(lambda *args: args)))
+    routes.append(web.StaticFileRoute())
+    static = dict([(r.path,r) for r in routes if r.is_static])
+    dynamic = [r for r in routes if not r.is_static]
+    def linear(path):
+        fn = static.get(path)
+        if fn:
+            return fn,()
+        for fn in dynamic:
+            args = fn.match(path)
+            if args:
+                return fn,args
+    router = web._Router()
+    for r in routes:
+        router.add(r)
+    for label,path in (('first route','/api/r1/7/items/9'),('last route','/api/r%d/7/items/9' % (n - 1)),
+                       ('static route','/api/r%d/list' % (n - 2)),('static file','/static/css/site.css')):
+        t,r = _timeit(lambda: [linear(path) for i in xrange(lookups)])
+        _report('scan: %s' % label,lookups,t)
+        t,r = _timeit(lambda: [router.match(path) for i in xrange(lookups)])
+        _report('tree: %s' % label,lookups,t)
+
+if __name__=='__main__':
+    if len(sys.argv) < 2 or not ('bench_' + sys.argv[1]) in globals():
+        print __doc__
+        print 'benchmarks:', ', '.join(sorted(k[6:] for k in globals() if k.startswith('bench_')))
+        sys.exit(1)
+    globals()['bench_' + sys.argv[1]](*sys.argv[2:])
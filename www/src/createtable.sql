@@ -30,6 +30,8 @@ create table blogs (
     `summary` varchar(200) not null,
     `content` mediumtext not null,
     `created_at` real not null,
+    `version` bigint not null default 0,
+    key `idx_user_id_created_at` (`user_id`,`created_at`),
     key `idx_created_at` (`created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
@@ -42,6 +44,25 @@ create table comments (
     `user_image` varchar(500) not null,
     `content` mediumtext not null,
     `created_at` real not null,
+    key `idx_blog_id_created_at` (`blog_id`,`created_at`),
+    key `idx_user_id` (`user_id`),
+    key `idx_created_at` (`created_at`),
+    primary key (`id`)
+) engine=innodb default charset=utf8;
+
+create table counters (
+    `name` varchar(255) not null,
+    `value` bigint not null,
+    primary key (`name`)
+) engine=innodb default charset=utf8;
+
+create table search_log (
+    `id` bigint not null auto_increment,
+    `name` varchar(50) not null,
+    `doc_id` varchar(50) not null,
+    `origin` varchar(100) not null default '',
+    `created_at` real not null,
+    key `idx_name_id` (`name`,`id`),
     key `idx_created_at` (`created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
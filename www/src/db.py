@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 #-*- coding:utf-8 -*-
 
-import time,uuid,threading,logging
+import os,time,threading,logging,re
 import functools
+import collections
+import itertools
 
 class Dict(dict):
     '''
@@ -41,13 +43,302 @@ class Dict(dict):
     def __setattr__(self,key,value):
         self[key] = value
 
+class _Schema(object):
+    '''
+    Column names of a result set and their positions, shared by its rows.
+    '''
+    __slots__ = ('names', 'index')
+    def __init__(self,names):
+        self.names = tuple(names)
+        self.index = dict((name,i) for i,name in enumerate(self.names))
+
+class Row(object):
+    '''
+    One row of a result set: a tuple of values and the schema shared by
+    all rows of the same result. Support attribute and mapping access
+    like Dict, and new keys may be set on it.
+
+    >>> s = _Schema(['id', 'name'])
+    >>> r = Row(s, (1, 'Bob'))
+    >>> r.name, r['id'], r.get('image', '')
+    ('Bob', 1, '')
+    >>> r.keys()
+    ['id', 'name']
+    >>> r.name = 'Alice'
+    >>> r['admin'] = False
+    >>> r
+    {'id': 1, 'name': 'Alice', 'admin': False}
+    >>> r == dict(id=1, name='Alice', admin=False)
+    True
+    >>> dict(**r)['name']
+    'Alice'
+    >>> r.email
+    Traceback (most recent call last):
+    ...
+    AttributeError: 'Row' object has no attribute email
+    >>> r.pop('admin'), r.setdefault('email', 'a@b.org')
+    (False, 'a@b.org')
+    >>> del r['name']
+    >>> r.update(image='about:blank')
+    >>> sorted(r.items())
+    [('email', 'a@b.org'), ('id', 1), ('image', 'about:blank')]
+    >>> isinstance(r, collections.Mapping)
+    True
+
+    Row is not a dict subclass, so json.dumps() needs default=json_default
+    for it, and isinstance(row, dict) is False: check for
+    collections.Mapping instead.
+    '''
+    __slots__ = ('_schema', '_values', '_extra')
+    def __init__(self,schema,values):
+        object.__setattr__(self,'_schema',schema)
+        object.__setattr__(self,'_values',values)
+        object.__setattr__(self,'_extra',None)
+    def __getitem__(self,key):
+        i = self._schema.index.get(key)
+        if i is not None:
+            return self._values[i]
+        if self._extra is not None:
+            return self._extra[key]
+        raise KeyError(key)
+    def __setitem__(self,key,value):
+        i = self._schema.index.get(key)
+        if i is not None:
+            values = list(self._values)
+            values[i] = value
+            object.__setattr__(self,'_values',tuple(values))
+        else:
+            if self._extra is None:
+                object.__setattr__(self,'_extra',{})
+            self._extra[key] = value
+    def __getattr__(self,key):
+        i = self._schema.index.get(key)
+        if i is not None:
+            return self._values[i]
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise AttributeError(r"'Row' object has no attribute %s" % key)
+    def __setattr__(self,key,value):
+        self[key] = value
+    def __delitem__(self,key):
+        if key in self._schema.index:
+            self._detach()
+        if self._extra is None:
+            raise KeyError(key)
+        del self._extra[key]
+    def _detach(self):
+        #give up the shared schema, the row keeps all its keys in _extra
+        object.__setattr__(self,'_extra',dict(self.iteritems()))
+        object.__setattr__(self,'_schema',_NO_COLUMNS)
+        object.__setattr__(self,'_values',())
+    def __contains__(self,key):
+        return key in self._schema.index or (self._extra is not None and key in self._extra)
+    has_key = __contains__
+    def __len__(self):
+        return len(self._values) + (len(self._extra) if self._extra else 0)
+    def get(self,key,default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    def iterkeys(self):
+        for key in self._schema.names:
+            yield key
+        if self._extra:
+            for key in self._extra:
+                yield key
+    __iter__ = iterkeys
+    def itervalues(self):
+        for key in self.iterkeys():
+            yield self[key]
+    def iteritems(self):
+        for key in self.iterkeys():
+            yield key,self[key]
+    def keys(self):
+        return list(self.iterkeys())
+    def values(self):
+        return list(self.itervalues())
+    def items(self):
+        return list(self.iteritems())
+    def pop(self,key,*default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+    def popitem(self):
+        for key in self.iterkeys():
+            return key,self.pop(key)
+        raise KeyError('popitem(): row is empty')
+    def setdefault(self,key,default=None):
+        if not key in self:
+            self[key] = default
+        return self[key]
+    def update(self,*args,**kw):
+        for other in args + (kw,):
+            pairs = other.iteritems() if hasattr(other,'iteritems') else other
+            for key,value in pairs:
+                self[key] = value
+    def clear(self):
+        object.__setattr__(self,'_schema',_NO_COLUMNS)
+        object.__setattr__(self,'_values',())
+        object.__setattr__(self,'_extra',None)
+    def copy(self):
+        return Dict(self.keys(),self.values())
+    def __eq__(self,other):
+        if isinstance(other,Row):
+            other = dict(other.iteritems())
+        return dict(self.iteritems())==other
+    def __ne__(self,other):
+        return not self==other
+    def __repr__(self):
+        return '{%s}' % ', '.join(['%r: %r' % (k,v) for k,v in self.iteritems()])
+    __str__ = __repr__
+    def __getstate__(self):
+        return (self._schema.names,self._values,self._extra)
+    def __setstate__(self,state):
+        self.__init__(_Schema(state[0]),state[1])
+        object.__setattr__(self,'_extra',state[2])
+
+_NO_COLUMNS = _Schema(())
+
+collections.MutableMapping.register(Row)
+
+def row_tuple(row):
+    '''
+    Return (names, values) of a row as two tuples, for code that builds
+    objects from rows by position.
+
+    >>> row_tuple(Row(_Schema(['id', 'name']), (1, 'Bob')))
+    (('id', 'name'), (1, 'Bob'))
+    '''
+    if isinstance(row, Row) and not row._extra:
+        return row._schema.names, row._values
+    return tuple(row.keys()), tuple(row.values())
+
+def json_default(obj):
+    '''
+    The default= hook of json.dumps() for rows.
+
+    >>> import json
+    >>> json.dumps([Row(_Schema(['id']), (1,))], default=json_default)
+    '[{"id": 1}]'
+    '''
+    if isinstance(obj, Row):
+        return dict(obj.iteritems())
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+#2015-01-01 00:00:00 UTC in milliseconds, ids count time from here
+_ID_EPOCH = 1420070400000
+_ID_WORKER_BITS = 10
+_ID_SEQUENCE_BITS = 12
+
+class _IdGenerator(object):
+    '''
+    Generate 63 bit ids ordered by time: milliseconds since _ID_EPOCH,
+    then the worker id (10 bits), then a sequence (12 bits) for ids in
+    the same millisecond. When the sequence runs out, or the clock goes
+    back, the ids borrow the next millisecond so they never repeat or
+    go backwards.
+
+    >>> g = _IdGenerator(5)
+    >>> a = g.next_int(1500000000.0)
+    >>> b = g.next_int(1500000000.0)
+    >>> b - a, (a >> 12) & 1023
+    (1, 5)
+    >>> g.next_int(1400000000.0) > b
+    True
+
+    pid is the process it was made in and explicit is False if the
+    worker id was derived from the pid rather than set.
+    '''
+    def __init__(self,worker_id,explicit=True):
+        if not 0 <= worker_id < (1 << _ID_WORKER_BITS):
+            raise ValueError('Bad worker id: %s' % worker_id)
+        self.worker_id = worker_id
+        self.explicit = explicit
+        self.pid = os.getpid()
+        self.warned = explicit
+        self._worker = worker_id << _ID_SEQUENCE_BITS
+        self._last = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+    def next_int(self,t=None):
+        ms = int((time.time() if t is None else t) * 1000) - _ID_EPOCH
+        with self._lock:
+            if ms <= self._last:
+                ms = self._last
+                self._sequence = (self._sequence + 1) & ((1 << _ID_SEQUENCE_BITS) - 1)
+                if self._sequence == 0:
+                    ms = ms + 1
+            else:
+                self._sequence = 0
+            self._last = ms
+            return (ms << (_ID_WORKER_BITS + _ID_SEQUENCE_BITS)) | self._worker | self._sequence
+
+def _default_worker_id():
+    #only unique among pids less than 1024 apart on one host, set_worker_id() is safe
+    import socket
+    return (os.getpid() ^ hash(socket.gethostname())) & ((1 << _ID_WORKER_BITS) - 1)
+
+_id_generator = _IdGenerator(_default_worker_id(),explicit=False)
+_id_lock = threading.Lock()
+
+def set_worker_id(worker_id):
+    '''
+    Set the worker id (0-1023) put in every id, it must be unique among
+    the processes writing the same tables. Servers that fork workers
+    must call it in each worker after the fork.
+    '''
+    global _id_generator
+    with _id_lock:
+        _id_generator = _IdGenerator(worker_id)
+
+def _generator():
+    '''
+    Return the id generator of this process. A forked child would carry
+    on with the worker id and sequence of its parent and make the same
+    ids, so it gets a new generator with a worker id from its own pid.
+    '''
+    global _id_generator
+    g = _id_generator
+    if g.pid != os.getpid():
+        with _id_lock:
+            g = _id_generator
+            if g.pid != os.getpid():
+                worker_id = _default_worker_id()
+                parent = g
+                g = _id_generator = _IdGenerator(worker_id,explicit=False)
+                if parent.explicit:
+                    g.warned = True
+                    logging.error('worker id %d was set before the process forked and is shared by its children, '
+                                  'using %d from the pid instead: call set_worker_id() in each worker.' % (parent.worker_id,worker_id))
+    if not g.warned:
+        g.warned = True
+        logging.warning('no worker id set, using %d derived from the pid and host name. It may collide with other '
+                        'processes writing the same tables, set worker_id in create_engine() for each process.' % g.worker_id)
+    return g
+
+def next_int_id(t=None):
+    '''
+    Return a unique 64 bit integer id ordered by time, for bigint keys.
+    '''
+    return _generator().next_int(t)
+
 def next_id(t=None):
     '''
-    To generate the UUID (Universally Unique Identifier)
-     '''
-    if t is None:
-        t = time.time()
-    return '%015d%s000' % (int(t * 1000), uuid.uuid4().hex)
+    Return a unique id ordered by time as a 16 char string, the
+    next_int_id() in fixed width hex so the strings sort like the ints.
+
+    >>> len(next_id())
+    16
+    >>> next_id(1500000000.0) < next_id(1500000000.0) < next_id()
+    True
+    '''
+    return '%016x' % _generator().next_int(t)
 
 def _profiling(start,sql=''):
     t = time.time() - start
@@ -56,24 +347,700 @@ def _profiling(start,sql=''):
     else:
         logging.info('[PROFILING] [DB] %s: %s' % (t,sql))
 
+class _LRUCache(object):
+    '''
+    A thread safe mapping bounded by size with least recently used
+    eviction, optional ttl in seconds and hit/miss/eviction counters.
+    on_evict(key, value) is called for entries pushed out by size or
+    found expired.
+
+    >>> c = _LRUCache(2)
+    >>> c.put('a', 1)
+    >>> c.put('b', 2)
+    >>> c.get('a')
+    1
+    >>> c.put('c', 3)
+    >>> c.get('b') is None
+    True
+    >>> s = c.stats()
+    >>> s.hits, s.misses, s.evictions, s.size
+    (1, 1, 1, 2)
+    >>> c.add('c', 4), c.add('d', 4, ttl=-1), c.add('d', 5)
+    (False, True, True)
+    '''
+    def __init__(self,size,ttl=None,on_evict=None,counters=None):
+        self._size = size
+        self._ttl = ttl
+        self._on_evict = on_evict
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = counters if counters is not None else dict(hits=0,misses=0,evictions=0)
+    def get(self,key,default=None):
+        with self._lock:
+            item = self._data.pop(key,None)
+            expired = item is not None and item[1] is not None and item[1] < time.time()
+            if item is not None and not expired:
+                self._data[key] = item
+                self._counters['hits'] = self._counters['hits'] + 1
+                return item[0]
+            self._counters['misses'] = self._counters['misses'] + 1
+        if expired and self._on_evict:
+            self._on_evict(key,item[0])
+        return default
+    def put(self,key,value,ttl=None):
+        '''
+        Store value under key, for ttl seconds if given instead of the
+        ttl of the cache.
+        '''
+        self._put(key,value,ttl,False)
+    def add(self,key,value,ttl=None):
+        '''
+        Store value like put() unless key holds a value not expired yet,
+        return True if it was stored.
+        '''
+        return self._put(key,value,ttl,True)
+    def _put(self,key,value,ttl,only_new):
+        now = time.time()
+        ttl = self._ttl if ttl is None else ttl
+        expires = None if ttl is None else now + ttl
+        evicted = []
+        with self._lock:
+            item = self._data.pop(key,None)
+            if only_new and item is not None and (item[1] is None or item[1] >= now):
+                self._data[key] = item
+                return False
+            self._data[key] = (value,expires)
+            while len(self._data) > self._size:
+                evicted.append(self._data.popitem(last=False))
+            self._counters['evictions'] = self._counters['evictions'] + len(evicted)
+        if self._on_evict:
+            for k,item in evicted:
+                self._on_evict(k,item[0])
+        return True
+    def pop(self,key,default=None):
+        with self._lock:
+            item = self._data.pop(key,None)
+        return default if item is None else item[0]
+    def clear(self):
+        with self._lock:
+            items = self._data.items()
+            self._data.clear()
+        return [(k,item[0]) for k,item in items]
+    def __len__(self):
+        return len(self._data)
+    def stats(self):
+        c = self._counters
+        total = c['hits'] + c['misses']
+        return Dict(size=len(self._data),capacity=self._size,hits=c['hits'],misses=c['misses'],
+                    evictions=c['evictions'],hit_rate=float(c['hits']) / total if total else 0.0)
+
+def _translate(sql):
+    '''
+    Translate '?' placeholders to the connector style. A plain replace
+    is cheaper than any cache keyed by the sql text.
+
+    >>> _translate('select * from users where id=?')
+    'select * from users where id=%s'
+    '''
+    return sql.replace('?', '%s')
+
+_RE_READ_TABLES = re.compile(r'\b(?:from|join)\s+`?(\w+)`?', re.IGNORECASE)
+_RE_WRITE_TABLE = re.compile(r'^\s*(?:(?:insert|replace)(?:\s+(?:ignore|low_priority|delayed))?\s+(?:into\s+)?|update\s+(?:low_priority\s+|ignore\s+)*|delete\s+(?:low_priority\s+|quick\s+|ignore\s+)*from\s+)`?(\w+)`?', re.IGNORECASE)
+
+def _read_tables(sql):
+    '''
+    Return the tables a select reads.
+
+    >>> _read_tables('select * from `blogs` b join users u on b.user_id=u.id where b.id=?')
+    frozenset(['blogs', 'users'])
+    '''
+    return frozenset([t.lower() for t in _RE_READ_TABLES.findall(sql)])
+
+def _written_table(sql):
+    '''
+    Return the table an insert/replace/update/delete writes, or None.
+
+    >>> _written_table('insert into `users` (`id`) values (?)')
+    'users'
+    >>> _written_table('update blogs set name=? where id=?')
+    'blogs'
+    >>> _written_table('delete from `comments` where id=?')
+    'comments'
+    >>> _written_table('truncate users') is None
+    True
+    '''
+    m = _RE_WRITE_TABLE.match(sql)
+    return m.group(1).lower() if m else None
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple([_freeze(v) for v in value])
+    return value
+
+_MISSING = object()
+
+class _StoredRow(tuple):
+    '''
+    A row as the query cache keeps it: the schema and the values tuple,
+    which nobody can change. Every hit makes rows of its own from it.
+    '''
+    __slots__ = ()
+    def row(self):
+        row = Row(self[0],self[1])
+        if self[2]:
+            object.__setattr__(row,'_extra',dict(self[2]))
+        return row
+
+def _store_result(r):
+    if isinstance(r, Row):
+        return _StoredRow((r._schema,r._values,r._extra and dict(r._extra)))
+    if isinstance(r, list):
+        return [_store_result(x) for x in r]
+    return r
+
+def _load_result(r):
+    if isinstance(r, _StoredRow):
+        return r.row()
+    if isinstance(r, list):
+        return [_load_result(x) for x in r]
+    return r
+
+class _QueryCache(object):
+    '''
+    Results of selects keyed by (sql, args), bounded by size and ttl and
+    indexed by the tables each statement reads, so a write to a table
+    drops every entry that read it. load returns the result and whether
+    it may be stored. A result loaded while one of its tables was
+    written is not stored either.
+
+    >>> c = _QueryCache(10, 60)
+    >>> c.fetch('select * from users', False, (), lambda: (['u1'], True))
+    ['u1']
+    >>> c.fetch('select * from users', False, (), lambda: (['u2'], True))
+    ['u1']
+    >>> c.invalidate(['users'])
+    >>> c.fetch('select * from users', False, (), lambda: (['u2'], False))
+    ['u2']
+    >>> c.fetch('select * from users', False, (), lambda: (['u3'], True))
+    ['u3']
+    >>> s = c.stats()
+    >>> s.hits, s.misses, s.invalidations
+    (1, 3, 1)
+    >>> r = c.fetch('select * from users where id=?', True, ('1',), lambda: (Row(_Schema(['name']), ('Bob',)), True))
+    >>> r.name = 'Alice'
+    >>> c.fetch('select * from users where id=?', True, ('1',), None).name
+    'Bob'
+    '''
+    def __init__(self,size=1000,ttl=60):
+        self._lock = threading.RLock()
+        self._results = _LRUCache(size,ttl,on_evict=self._forget)
+        self._parsed = _LRUCache(size)
+        self._keys = {}
+        self._generations = {}
+        self._invalidations = 0
+    def _tables(self,sql):
+        tables = self._parsed.get(sql)
+        if tables is None:
+            tables = _read_tables(sql)
+            self._parsed.put(sql,tables)
+        return tables
+    def _generation(self,tables):
+        return tuple([self._generations.get(t,0) for t in tables])
+    def _forget(self,key,value):
+        with self._lock:
+            for t in self._tables(key[0]):
+                keys = self._keys.get(t)
+                if keys is not None:
+                    keys.discard(key)
+    def fetch(self,sql,first,args,load):
+        tables = self._tables(sql)
+        if not tables:
+            return load()[0]
+        key = (sql,first,_freeze(args))
+        try:
+            hash(key)
+        except TypeError:
+            return load()[0]
+        r = self._results.get(key,_MISSING)
+        if r is _MISSING:
+            with self._lock:
+                generation = self._generation(tables)
+            r,store = load()
+            with self._lock:
+                if store and self._generation(tables)==generation:
+                    self._results.put(key,_store_result(r))
+                    for t in tables:
+                        self._keys.setdefault(t,set()).add(key)
+            return r
+        return _load_result(r)
+    def invalidate(self,tables=None):
+        '''
+        Drop the results reading any of the tables, all of them if None.
+        '''
+        with self._lock:
+            self._invalidations = self._invalidations + 1
+            if tables is None:
+                self._results.clear()
+                self._keys.clear()
+                for t in self._generations:
+                    self._generations[t] = self._generations[t] + 1
+                return
+            for t in tables:
+                self._generations[t] = self._generations.get(t,0) + 1
+                for key in self._keys.pop(t,()):
+                    self._results.pop(key)
+    def stats(self):
+        d = self._results.stats()
+        d.invalidations = self._invalidations
+        return d
+
+_query_cache = None
+
+def enable_query_cache(size=1000,ttl=60):
+    '''
+    Cache select results keyed by (sql, args) for at most ttl seconds.
+    Pass size=0 to disable the cache.
+    '''
+    global _query_cache
+    _query_cache = _QueryCache(size,ttl) if size > 0 else None
+
+def query_cache_stats():
+    '''
+    Return the hit/miss/eviction/invalidation counters of the query cache.
+    '''
+    if _query_cache is None:
+        raise DBError('Query cache is not enabled.')
+    return _query_cache.stats()
+
+def _invalidate(sql):
+    '''
+    Invalidate the cached results of the table sql writes, after commit.
+    '''
+    if _query_cache is not None:
+        table = _written_table(sql)
+        on_commit(lambda: _query_cache.invalidate(None if table is None else [table]))
+
 class DBError(Exception):
     pass
 
 class MultiColumnsError(DBError):
     pass
 
+class PoolTimeoutError(DBError):
+    pass
+
 engine = None
 
+#upper bound in bytes of one multi-row statement, keep it under max_allowed_packet
+_max_packet = 1024 * 1024
+
+class _PooledConnection(object):
+    '''
+    A raw connection plus the bookkeeping the pool needs:
+    when it was opened and when it was last handed out or returned.
+
+    stream is the _Stream iter_select() is reading from the connection,
+    if any. The protocol allows one unread result per connection, so
+    every other statement first drains its rows into memory.
+    '''
+    def __init__(self,raw,statement_cache=0,counters=None):
+        self.raw = raw
+        self.created_at = self.last_used = time.time()
+        self.stream = None
+        self._prepared = None
+        if statement_cache > 0:
+            self._prepared = _LRUCache(statement_cache,on_evict=lambda sql,c: c.discard(),counters=counters)
+    def _drain(self):
+        if self.stream is not None:
+            stream, self.stream = self.stream, None
+            stream.drain()
+    def cursor(self,*args,**kw):
+        self._drain()
+        return self.raw.cursor(*args,**kw)
+    def statement(self,sql):
+        '''
+        Return a buffered cursor for sql. When server side prepared
+        statements are enabled it is instead a prepared cursor kept per
+        connection and reused for the same sql text, so MySQL parses it
+        only once.
+        '''
+        self._drain()
+        if self._prepared is None:
+            return self.raw.cursor(buffered=True)
+        cursor = self._prepared.get(sql)
+        if cursor is None:
+            try:
+                #prepared cursors cannot be buffered, _PreparedCursor reads what is left on close()
+                cursor = _PreparedCursor(self.raw.cursor(buffered=False,prepared=True))
+            except Exception:
+                logging.warning('connector does not support prepared statements, disabled.')
+                self._prepared = None
+                return self.raw.cursor(buffered=True)
+            self._prepared.put(sql,cursor)
+        return cursor
+    def commit(self):
+        self._drain()
+        self.raw.commit()
+    def rollback(self):
+        self._drain()
+        self.raw.rollback()
+    def in_transaction(self):
+        #connectors that cannot tell are treated as always in transaction
+        return getattr(self.raw,'in_transaction',True)
+    def ping(self):
+        ping = getattr(self.raw,'ping',None)
+        if ping is None:
+            return True
+        try:
+            ping()
+            return True
+        except Exception:
+            return False
+    def close(self):
+        if self._prepared is not None:
+            for sql,cursor in self._prepared.clear():
+                cursor.discard()
+        try:
+            self.raw.close()
+        except Exception:
+            logging.exception('close connection <%s> failed.' % hex(id(self.raw)))
+
+class _Stream(object):
+    '''
+    An unbuffered cursor iter_select() reads in chunks from a connection
+    it shares with the scope. drain() reads the rows left into memory so
+    the connection is free for another statement, fetch() then serves
+    them from there. close() throws away the rows left chunk by chunk.
+    '''
+    def __init__(self,cursor):
+        self.cursor = cursor
+        self._rows = None
+        self._pos = 0
+    def fetch(self,size):
+        if self._rows is None:
+            return self.cursor.fetchmany(size)
+        rows = self._rows[self._pos:self._pos + size]
+        self._pos = self._pos + len(rows)
+        return rows
+    def drain(self):
+        if self._rows is None:
+            self._rows = self.cursor.fetchall()
+            self.cursor.close()
+    def close(self,size=1000):
+        try:
+            if self._rows is None:
+                while self.cursor.fetchmany(size):
+                    pass
+                self.cursor.close()
+        except Exception:
+            logging.exception('close stream cursor failed.')
+        self._rows = ()
+
+class _PreparedCursor(object):
+    '''
+    A prepared cursor owned by the statement cache of a connection,
+    close() only drops unread rows so the statement stays prepared.
+    '''
+    def __init__(self,cursor):
+        self._cursor = cursor
+    def __getattr__(self,key):
+        return getattr(self._cursor,key)
+    def close(self):
+        try:
+            self._cursor.fetchall()
+        except Exception:
+            pass
+    def discard(self):
+        try:
+            self._cursor.close()
+        except Exception:
+            pass
+
 class _Engine(object):
-    def __init__(self,connect):
+    '''
+    A bounded pool of connections made by the connect function.
+
+    Connections are borrowed by connect() and given back by release().
+    Idle connections are reaped after max_idle seconds (but never below
+    min_size), any connection is retired after max_lifetime seconds, and
+    a connection idle for more than ping_interval seconds is pinged
+    before it is handed out again. With statement_cache > 0 every
+    connection keeps up to that many server side prepared statements.
+
+    >>> class _Conn(object):
+    ...     def cursor(self): pass
+    ...     def commit(self): pass
+    ...     def rollback(self): pass
+    ...     def close(self): pass
+    >>> e = _Engine(_Conn, max_size=2, timeout=0.01)
+    >>> c1 = e.connect()
+    >>> c2 = e.connect()
+    >>> e.connect()
+    Traceback (most recent call last):
+    ...
+    PoolTimeoutError: No free connection in pool after 0.01 seconds.
+    >>> e.release(c1)
+    >>> e.connect() is c1
+    True
+    >>> s = e.stats()
+    >>> s.size, s.idle, s.in_use, s.created, s.timeouts
+    (2, 0, 2, 2, 1)
+    '''
+    def __init__(self,connect,min_size=0,max_size=10,timeout=10.0,max_idle=600.0,max_lifetime=3600.0,ping_interval=5.0,statement_cache=0):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError('Bad pool size: min=%s, max=%s' % (min_size,max_size))
         self._connect = connect
+        self._min_size = min_size
+        self._max_size = max_size
+        self._timeout = timeout
+        self._max_idle = max_idle
+        self._max_lifetime = max_lifetime
+        self._ping_interval = ping_interval
+        self._statement_cache = statement_cache
+        self._prepared_counters = dict(hits=0,misses=0,evictions=0)
+        self._cond = threading.Condition(threading.Lock())
+        #idle connections, the most recently returned one is the last
+        self._idle = []
+        self._size = 0
+        self._waiting = 0
+        self._counters = dict(created=0,closed=0,checkouts=0,timeouts=0,ping_failures=0)
+        for i in range(min_size):
+            self._idle.append(self._open())
+            self._size = self._size + 1
+    def _open(self):
+        conn = _PooledConnection(self._connect(),self._statement_cache,self._prepared_counters)
+        with self._cond:
+            self._counters['created'] = self._counters['created'] + 1
+        logging.info('open connection <%s>...' % hex(id(conn.raw)))
+        return conn
+    def _close(self,conn):
+        conn.close()
+        with self._cond:
+            self._counters['closed'] = self._counters['closed'] + 1
+        logging.info('close connection <%s> ok.' % hex(id(conn.raw)))
+    def _expired(self,conn,now):
+        return now - conn.created_at > self._max_lifetime
+    def _reap(self,now):
+        '''
+        Take out idle connections that are too old, must hold the lock.
+        '''
+        dead = []
+        keep = []
+        for conn in self._idle:
+            if self._expired(conn,now):
+                dead.append(conn)
+            elif now - conn.last_used > self._max_idle and self._size - len(dead) > self._min_size:
+                dead.append(conn)
+            else:
+                keep.append(conn)
+        self._idle = keep
+        self._size = self._size - len(dead)
+        return dead
+    def _checkout(self,deadline,dead):
+        '''
+        Return an idle connection, or None if the caller may open a new one.
+        '''
+        with self._cond:
+            while True:
+                dead.extend(self._reap(time.time()))
+                if self._idle:
+                    return self._idle.pop()
+                if self._size < self._max_size:
+                    self._size = self._size + 1
+                    return None
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._counters['timeouts'] = self._counters['timeouts'] + 1
+                    raise PoolTimeoutError('No free connection in pool after %s seconds.' % self._timeout)
+                self._waiting = self._waiting + 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting = self._waiting - 1
+    def _drop(self,conn):
+        with self._cond:
+            self._size = self._size - 1
+            self._cond.notify()
+        if conn is not None:
+            self._close(conn)
     def connect(self):
-        return self._connect()
+        '''
+        Borrow a connection from the pool, waiting at most timeout seconds.
+        '''
+        deadline = time.time() + self._timeout
+        while True:
+            dead = []
+            try:
+                conn = self._checkout(deadline,dead)
+            finally:
+                for c in dead:
+                    self._close(c)
+            if conn is None:
+                try:
+                    conn = self._open()
+                except:
+                    self._drop(None)
+                    raise
+            elif time.time() - conn.last_used > self._ping_interval and not conn.ping():
+                with self._cond:
+                    self._counters['ping_failures'] = self._counters['ping_failures'] + 1
+                self._drop(conn)
+                continue
+            with self._cond:
+                self._counters['checkouts'] = self._counters['checkouts'] + 1
+            conn.last_used = time.time()
+            return conn
+    def release(self,conn,discard=False):
+        '''
+        Give a borrowed connection back to the pool, or close it and
+        free its slot if discard is True.
+        '''
+        if discard:
+            self._drop(conn)
+            return
+        broken = False
+        try:
+            #do not hand an open transaction (or its snapshot) to the next user
+            if conn.in_transaction():
+                conn.rollback()
+        except Exception:
+            broken = True
+        now = time.time()
+        if broken or self._expired(conn,now):
+            self._drop(conn)
+            return
+        with self._cond:
+            conn.last_used = now
+            self._idle.append(conn)
+            self._cond.notify()
+    @property
+    def busy(self):
+        '''
+        The number of borrowed connections, read without the lock.
+        '''
+        return self._size - len(self._idle)
+    def dispose(self):
+        '''
+        Close all idle connections, borrowed ones are closed when released.
+        '''
+        with self._cond:
+            idle = self._idle
+            self._idle = []
+            self._size = self._size - len(idle)
+            self._max_lifetime = -1
+        for conn in idle:
+            self._close(conn)
+    def stats(self):
+        '''
+        Return a snapshot of the pool usage as Dict.
+        '''
+        with self._cond:
+            d = Dict(size=self._size,idle=len(self._idle),in_use=self._size - len(self._idle),
+                     waiting=self._waiting,min_size=self._min_size,max_size=self._max_size)
+            d.update(self._counters)
+        return d
+    def statement_stats(self):
+        '''
+        Return the prepared statement counters summed over all connections.
+        '''
+        c = self._prepared_counters
+        total = c['hits'] + c['misses']
+        return Dict(capacity=self._statement_cache,hits=c['hits'],misses=c['misses'],evictions=c['evictions'],
+                    hit_rate=float(c['hits']) / total if total else 0.0)
+
+class _ReplicaSet(object):
+    '''
+    The replica engines reads are spread over, by round robin or by the
+    fewest borrowed connections. A replica that fails is ejected for
+    eject_seconds and tried again after that.
+
+    >>> class _E(object):
+    ...     def __init__(self, busy): self.busy = busy
+    >>> a, b = _E(3), _E(1)
+    >>> r = _ReplicaSet([('a', a), ('b', b)])
+    >>> r.choose() is a, r.choose() is b, r.choose() is a
+    (True, True, True)
+    >>> r.eject(a)
+    >>> r.choose() is b, r.choose() is b
+    (True, True)
+    >>> r.eject(b)
+    >>> r.choose() is None
+    True
+    >>> _ReplicaSet([('a', a), ('b', b)], policy='least_busy').choose() is b
+    True
+    '''
+    def __init__(self,engines,policy='round_robin',eject_seconds=30.0):
+        if not policy in ('round_robin','least_busy'):
+            raise ValueError('Bad replica policy: %s' % policy)
+        self._engines = list(engines)
+        self._policy = policy
+        self._eject_seconds = eject_seconds
+        self._ejected = {}
+        self._ejections = {}
+        self._next = 0
+        self._lock = threading.Lock()
+    def choose(self):
+        '''
+        Return a healthy replica engine, or None if all are ejected.
+        '''
+        now = time.time()
+        with self._lock:
+            healthy = [e for name,e in self._engines if self._ejected.get(e,0) <= now]
+            if not healthy:
+                return None
+            if self._policy=='least_busy':
+                return min(healthy,key=lambda e: e.busy)
+            self._next = (self._next + 1) % len(healthy)
+            return healthy[self._next - 1]
+    def eject(self,engine):
+        with self._lock:
+            self._ejected[engine] = time.time() + self._eject_seconds
+            self._ejections[engine] = self._ejections.get(engine,0) + 1
+        logging.warning('eject replica <%s> for %s seconds.' % (hex(id(engine)),self._eject_seconds))
+    def stats(self):
+        now = time.time()
+        L = []
+        for name,e in self._engines:
+            d = e.stats()
+            d.name = name
+            d.healthy = self._ejected.get(e,0) <= now
+            d.ejections = self._ejections.get(e,0)
+            L.append(d)
+        return L
+
+#None or the _ReplicaSet selects go to
+_replicas = None
+
+_POOL_OPTIONS = dict(pool_min='min_size',pool_size='max_size',pool_timeout='timeout',
+                     pool_idle='max_idle',pool_recycle='max_lifetime',pool_ping='ping_interval',
+                     prepared_statements='statement_cache')
 
 def create_engine(user,password,database,host='127.0.0.1',port=3306,**kw):
     '''
     Create the Mysql connector Engine
 
+    Pool options (pool_min, pool_size, pool_timeout, pool_idle,
+    pool_recycle, pool_ping) and prepared_statements (the number of
+    server side prepared statements cached per connection, 0 to
+    disable) are taken out of kw, and so is max_packet (the size in
+    bytes insert_many() keeps each statement under) and query_cache
+    (a dict of size and ttl for enable_query_cache()), the rest is
+    passed to mysql.connector.connect().
+
+    replicas is a list of dicts overriding the connect params (host,
+    port, user...) for read replicas, each gets its own pool. Selects
+    outside a transaction go to a replica picked by replica_policy
+    ('round_robin' or 'least_busy') until the first write of the
+    connection scope, after that they stick to the primary. A replica
+    that fails is ejected for replica_eject seconds. With the query
+    cache enabled too, cacheable selects that miss it are read from the
+    primary, only hits are spared the trip.
+
+    worker_id (0-1023) sets the worker part of next_id(), it defaults
+    to a value derived from the pid and host name (with a warning, as
+    it may collide). Every process writing the same tables needs its
+    own, servers that fork workers must set it after the fork.
+
     >>> create_engine('root','123456','myblog')
     >>> create_engine('root','123456','myblog')
     Traceback (most recent call last):
@@ -81,7 +1048,9 @@ def create_engine(user,password,database,host='127.0.0.1',port=3306,**kw):
     DBError: Engine is already initialized.
     '''
     import mysql.connector
-    global engine
+    global engine, _max_packet, _replicas
+    if 'worker_id' in kw:
+        set_worker_id(kw.pop('worker_id'))
     engine = None
     if engine is not None:
         raise DBError ('Engine is already initialized.')
@@ -89,37 +1058,149 @@ def create_engine(user,password,database,host='127.0.0.1',port=3306,**kw):
     defaults = dict(use_unicode=True,charset='utf8',collation='utf8_general_ci',autocommit=False)
     for key,value in defaults.iteritems():
         params[key] = kw.pop(key,value)
+    pool = {}
+    for key,name in _POOL_OPTIONS.iteritems():
+        if key in kw:
+            pool[name] = kw.pop(key)
+    replicas = kw.pop('replicas',None) or []
+    policy = kw.pop('replica_policy','round_robin')
+    eject_seconds = kw.pop('replica_eject',30.0)
+    _max_packet = kw.pop('max_packet',_max_packet)
+    query_cache = kw.pop('query_cache',None)
+    if query_cache is not None:
+        enable_query_cache(**query_cache)
     params.update(kw)
-    params['buffered'] = True
-    engine = _Engine(lambda: mysql.connector.connect(**params))
+    engine = _Engine(_connector(mysql.connector.connect,params),**pool)
     logging.info('Init mysql engine <%s> ok.' % hex (id(engine)))
+    _replicas = None
+    if replicas:
+        engines = []
+        for replica in replicas:
+            replica_params = dict(params)
+            replica_params.update(replica)
+            name = '%s:%s' % (replica_params['host'],replica_params['port'])
+            engines.append((name,_Engine(_connector(mysql.connector.connect,replica_params),**pool)))
+            logging.info('Init mysql replica engine %s ok.' % name)
+        _replicas = _ReplicaSet(engines,policy,eject_seconds)
+
+def _connector(connect,params):
+    return lambda: connect(**params)
+
+def pool_stats():
+    '''
+    Return the connection pool usage of the engine as Dict.
+    '''
+    if engine is None:
+        raise DBError('Engine is not initialized.')
+    return engine.stats()
+
+def replica_stats():
+    '''
+    Return the pool usage and health of every replica as a list of Dict.
+    '''
+    return _replicas.stats() if _replicas is not None else []
+
+def statement_stats():
+    '''
+    Return the hit rate of the prepared statement caches as Dict.
+    '''
+    if engine is None:
+        raise DBError('Engine is not initialized.')
+    return engine.statement_stats()
 
 class _LasyConnection(object):
 
     def __init__(self):
         self.connection = None
-    def cursor(self):
+        self.replica = None
+        self.replica_engine = None
+    def primary(self):
+        '''
+        Return the pooled connection to the primary, borrowed on first use.
+        '''
         global engine
         if self.connection == None:
-            connection = engine.connect()
-            logging.info('open connection <%s>...' % hex(id(connection)))
-            self.connection = connection
-        return self.connection.cursor()
+            self.connection = engine.connect()
+        return self.connection
+    def reader(self):
+        '''
+        Return the pooled connection to a replica, or to the primary if
+        there is no healthy replica. The replica is kept for the
+        connection scope.
+        '''
+        if self.replica is None:
+            replica = _replicas.choose() if _replicas is not None else None
+            if replica is None:
+                return self.primary()
+            try:
+                self.replica = replica.connect()
+            except Exception:
+                logging.exception('connect replica failed.')
+                _replicas.eject(replica)
+                return self.primary()
+            self.replica_engine = replica
+        return self.replica
+    def cursor(self,sql=None):
+        if sql is None:
+            return self.primary().cursor(buffered=True)
+        return self.primary().statement(sql)
+    def read_cursor(self,sql):
+        '''
+        Return a cursor for sql on the connection reader() picks.
+        '''
+        return self.reader().statement(sql)
+    def replica_failed(self):
+        '''
+        Eject the replica if its connection is dead and return True, the
+        caller should then retry on the primary.
+        '''
+        if self.replica is None or self.replica.ping():
+            return False
+        replica, replica_engine = self.replica, self.replica_engine
+        self.replica = self.replica_engine = None
+        replica_engine.release(replica,discard=True)
+        _replicas.eject(replica_engine)
+        return True
     def commit(self):
-        self.connection.commit()
+        if self.connection:
+            self.connection.commit()
     def rollback(self):
-        self.connection.rollback()
+        if self.connection:
+            self.connection.rollback()
+    def drop(self,conn):
+        '''
+        Close conn, the primary or replica connection of the scope, rather
+        than read the result left on it. The next statement borrows
+        another one. Return False if conn is not one of them any more.
+        '''
+        if conn is self.replica:
+            replica_engine = self.replica_engine
+            self.replica = self.replica_engine = None
+            replica_engine.release(conn,discard=True)
+            return True
+        if conn is self.connection:
+            self.connection = None
+            engine.release(conn,discard=True)
+            return True
+        return False
     def cleanup(self):
+        #a stream left unread would have to be drained first, dropping the connection is cheaper
+        if self.replica:
+            replica, replica_engine = self.replica, self.replica_engine
+            self.replica = self.replica_engine = None
+            replica_engine.release(replica,discard=replica.stream is not None)
         if self.connection:
             connection = self.connection
             self.connection = None
-            connection.close()
-            logging.info('close connection <%s> ok.' % hex (id(connection)))
+            engine.release(connection,discard=connection.stream is not None)
 
 class _DbCtx(threading.local):
     def __init__(self):
         self.connection = None
         self.transactions = 0
+        self.after_commit = []
+        self.wrote = False
+        self.identity = None
     def is_init(self):
         '''
         return True or False
@@ -130,7 +1211,16 @@ class _DbCtx(threading.local):
     def init(self):
         self.connection = _LasyConnection()
         self.transactions = 0
+        self.after_commit = []
+        self.wrote = False
+        self.identity = {}
+    def use_primary(self):
+        '''
+        Reads go to the primary inside a transaction and after a write.
+        '''
+        return self.wrote or self.transactions > 0
     def cleanup(self):
+        self.identity = None
         self.connection.cleanup()
         self.connection = None
     def cursor(self):
@@ -177,6 +1267,31 @@ def connection():
     '''
     return _ConnectionCtx()
 
+def identity_map():
+    '''
+    Return the dict the orm keeps loaded objects in for the current
+    connection scope, or None outside of one. It is dropped when the
+    outermost scope ends.
+
+    >>> identity_map() is None
+    True
+    >>> with connection():
+    ...     identity_map()
+    {}
+    '''
+    global _db_ctx
+    return _db_ctx.identity
+
+def in_transaction():
+    '''
+    Return True inside a transaction() of the current thread.
+
+    >>> in_transaction()
+    False
+    '''
+    global _db_ctx
+    return _db_ctx.transactions > 0
+
 def with_connection(func):
     '''
     This is a Decorator for resuse connection
@@ -202,7 +1317,7 @@ class _TransactionCtx(object):
     def __enter__(self):
         global _db_ctx
         self.should_close_conn = False
-        if not _db_ctx.init():
+        if not _db_ctx.is_init():
             _db_ctx.init()
             self.should_close_conn = True
         _db_ctx.transactions = _db_ctx.transactions + 1
@@ -221,15 +1336,39 @@ class _TransactionCtx(object):
                 _db_ctx.cleanup()
     def commit(self):
         global _db_ctx
+        callbacks = _db_ctx.after_commit
+        _db_ctx.after_commit = []
         try:
             _db_ctx.connection.commit()
         except:
             _db_ctx.connection.rollback()
             raise
+        for func in callbacks:
+            func()
     def rollback(self):
         global _db_ctx
+        _db_ctx.after_commit = []
         _db_ctx.connection.rollback()
 
+def on_commit(func):
+    '''
+    Call func once the current transaction commits, or right away when
+    not in a transaction. Nothing is called if the transaction rolls back.
+
+    >>> L = []
+    >>> on_commit(lambda: L.append(1))
+    >>> with transaction():
+    ...     on_commit(lambda: L.append(2))
+    ...     L.append(len(L))
+    >>> L
+    [1, 1, 2]
+    '''
+    global _db_ctx
+    if _db_ctx.transactions > 0:
+        _db_ctx.after_commit.append(func)
+    else:
+        func()
+
 def transaction():
     '''
     Create a transaction object so can use with statement:
@@ -293,31 +1432,61 @@ def with_tarnsaction(func):
             return func(*args,**kw)
     return wrapper
 
-def _select(sql, first, *args):
-    ' execute select SQL and return unique result or list results.'
+def _select(sql, first, *args, **kw):
+    '''
+    Return the cached result if the query cache is enabled, cache is
+    not False in kw and selects may go to a replica (no transaction is
+    running and the scope has not written), otherwise execute it. Cache
+    misses are read from the primary, a replica may lag behind and its
+    rows would be served for the whole ttl.
+    '''
+    global _db_ctx
+    primary = kw.pop('primary', False)
+    if kw.pop('cache', True) and not primary and _query_cache is not None and not _db_ctx.use_primary():
+        return _query_cache.fetch(sql, first, args, lambda: (_execute_select(sql, first, args, True), True))
+    return _execute_select(sql, first, args, primary)
+
+def _execute_select(sql, first, args, primary=False):
+    '''
+    execute select SQL and return unique result or list results.
+    primary=True never reads a replica.
+    '''
     global _db_ctx
     cursor = None
-    sql = sql.replace('?', '%s')
+    sql = _translate(sql)
     logging.info('SQL: %s, ARGS: %s' % (sql, args))
     try:
-        cursor = _db_ctx.connection.cursor()
-        cursor.execute(sql, *args)
+        if primary or _replicas is None or _db_ctx.use_primary():
+            cursor = _db_ctx.connection.cursor(sql)
+            cursor.execute(sql, *args)
+        else:
+            cursor = _db_ctx.connection.read_cursor(sql)
+            try:
+                cursor.execute(sql, *args)
+            except Exception:
+                if not _db_ctx.connection.replica_failed():
+                    raise
+                logging.warning('retry on primary: %s' % sql)
+                cursor = _db_ctx.connection.cursor(sql)
+                cursor.execute(sql, *args)
         if cursor.description:
-            names = [x[0] for x in cursor.description]
+            schema = _Schema([x[0] for x in cursor.description])
         if first:
             values = cursor.fetchone()
             if not values:
                 return None
-            return Dict(names, values)
-        return [Dict(names, x) for x in cursor.fetchall()]
+            return Row(schema, tuple(values))
+        return [Row(schema, tuple(x)) for x in cursor.fetchall()]
     finally:
         if cursor:
             cursor.close()
 
 @with_connection
-def select_one(sql, *args):
+def select_one(sql, *args, **kw):
     '''
     Return one item metting the conditions.
+    Pass cache=False to bypass the query cache, primary=True to read
+    from the primary and not from the cache or a replica.
     
     >>> u1 = dict(id='900305', name='Java', email='Java@test.org', password='Java', created_at='0')
     >>> insert('users',**u1)
@@ -326,25 +1495,29 @@ def select_one(sql, *args):
     >>> select_one('select * from users where id=?', [900305]).name
     u'Java'
     '''
-    return _select(sql, True, *args)
+    return _select(sql, True, *args, **kw)
 
 @with_connection
-def select_int(sql, *args):
+def select_int(sql, *args, **kw):
     '''
     Return the count metting the conditions.
+    Pass cache=False to bypass the query cache, primary=True to read
+    from the primary and not from the cache or a replica.
 
     >>> select_int('select count(*) from users')
     3
     '''
-    d = _select(sql, True, *args)
+    d = _select(sql, True, *args, **kw)
     if len(d)!=1:
         raise MultiColumnsError('Expect only one column.')
     return d.values()[0]
 
 @with_connection
-def select(sql, *args):
+def select(sql, *args, **kw):
     '''
     Return the list metting the conditions.
+    Pass cache=False to bypass the query cache, primary=True to read
+    from the primary and not from the cache or a replica.
 
     >>> u1 = dict(id='900306', name='C#', email='C#@test.org', password='C#', created_at='0')
     >>> insert('users',**u1)
@@ -357,16 +1530,129 @@ def select(sql, *args):
     >>> select('select * from users',[])
     [{u'created_at': 0.0, u'name': u'C#', u'admin': 0, u'image': u'', u'email': u'C#@test.org', u'password': u'C#', u'id': u'900306'}, {u'created_at': 0.0, u'name': u'Matlab', u'admin': 0, u'image': u'', u'email': u'Matlab@test.org', u'password': u'Matlab', u'id': u'900307'}, {u'created_at': 0.0, u'name': u'Perf', u'admin': 0, u'image': u'', u'email': u'Perf@test.org', u'password': u'Perf', u'id': u'900308'}]
     '''
-    return _select(sql, False, *args)
+    return _select(sql, False, *args, **kw)
+
+def iter_select(sql, *args, **kw):
+    '''
+    Return a generator yielding the rows of a select lazily, fetched
+    chunk_size (keyword only, default 1000) rows at a time through an
+    unbuffered cursor.
+
+    Inside a transaction the generator reads on the primary connection
+    of the scope, so it sees the uncommitted writes of the transaction.
+    Another statement of the transaction while the generator is
+    suspended first reads the rows left into memory. Otherwise it
+    borrows its own pooled connection on the first next() and keeps it
+    until it is exhausted or closed, so the loop body can run other
+    statements (prefetch, lazy loads) on the scope connection without
+    ending the stream.
+
+    for blog in iter_select('select * from blogs where user_id=?', [uid], chunk_size=500):
+        pass
+    '''
+    chunk_size = kw.pop('chunk_size', 1000)
+    if kw:
+        raise TypeError('Unexpected keyword arguments: %s' % ','.join(kw))
+    if engine is None:
+        raise DBError('Engine is not initialized.')
+    sql = _translate(sql)
+    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    if _db_ctx.is_init() and _db_ctx.transactions > 0:
+        scope = _db_ctx.connection
+        conn = scope.primary()
+        stream = _open_stream(conn, sql, args)
+        for row in _read_stream(scope, conn, stream, chunk_size):
+            yield row
+        return
+    source = engine
+    if _replicas is not None and not _db_ctx.use_primary():
+        source = _replicas.choose() or engine
+    source, conn, cursor = _borrow_cursor(source, sql, args)
+    done = False
+    try:
+        schema = _Schema([x[0] for x in cursor.description])
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for values in rows:
+                yield Row(schema, tuple(values))
+        done = True
+    finally:
+        if done:
+            cursor.close()
+        #unread rows would have to be drained first, dropping the connection is cheaper
+        source.release(conn, discard=not done)
+
+def _borrow_cursor(source, sql, args):
+    '''
+    Borrow a connection of the source engine and execute sql on an
+    unbuffered cursor of it, return (source, connection, cursor). A
+    replica that cannot connect or whose connection died is ejected and
+    the primary is used instead.
+    '''
+    conn = None
+    try:
+        conn = source.connect()
+        cursor = conn.cursor(buffered=False)
+        cursor.execute(sql, *args)
+        return source, conn, cursor
+    except Exception:
+        alive = conn is not None and conn.ping()
+        if conn is not None:
+            source.release(conn, discard=not alive)
+        if source is engine or alive:
+            raise
+        _replicas.eject(source)
+        logging.warning('retry on primary: %s' % sql)
+        return _borrow_cursor(engine, sql, args)
+
+def _open_stream(conn, sql, args):
+    cursor = conn.cursor(buffered=False)
+    try:
+        cursor.execute(sql, *args)
+    except Exception:
+        try:
+            cursor.close()
+        except Exception:
+            pass
+        raise
+    conn.stream = _Stream(cursor)
+    return conn.stream
+
+def _read_stream(scope, conn, stream, chunk_size):
+    done = False
+    try:
+        schema = _Schema([x[0] for x in stream.cursor.description])
+        while True:
+            rows = stream.fetch(chunk_size)
+            if not rows:
+                break
+            for values in rows:
+                yield Row(schema, tuple(values))
+        done = True
+    finally:
+        unread = conn.stream is stream
+        if unread:
+            conn.stream = None
+        owned = conn is scope.connection or conn is scope.replica
+        #left early: outside a transaction nothing is lost by dropping the
+        #connection, inside one the rows left are read and thrown away.
+        #A connection the scope already dropped needs neither.
+        if done or not unread:
+            stream.close(chunk_size)
+        elif owned and not (_db_ctx.transactions==0 and scope.drop(conn)):
+            stream.close(chunk_size)
 
 @with_connection
 def _update(sql, *args):
     global _db_ctx
     cursor = None
-    sql = sql.replace('?', '%s')
+    sql = _translate(sql)
     logging.info('SQL: %s, ARGS: %s' % (sql, args))
     try:
-        cursor = _db_ctx.connection.cursor()
+        cursor = _db_ctx.connection.cursor(sql)
+        _db_ctx.wrote = True
         print sql,args
         cursor.execute(sql, args)
         r = cursor.rowcount
@@ -374,6 +1660,7 @@ def _update(sql, *args):
             # no transaction enviroment:
             logging.info('auto commit')
             _db_ctx.connection.commit()
+        _invalidate(sql)
         return r
     finally:
         if cursor:
@@ -395,6 +1682,123 @@ def insert(table, **kw):
 def update(sql, *args):
     return _update(sql, *args)
 
+def _packet_size(values):
+    '''
+    Estimate the bytes the values take in a statement, a little high.
+
+    >>> _packet_size(['abc', u'\u4e2d', 12, None])
+    63
+    '''
+    n = 0
+    for v in values:
+        if isinstance(v, unicode):
+            n = n + len(v) * 3 + 3
+        elif isinstance(v, str):
+            n = n + len(v) * 2 + 3
+        else:
+            n = n + 24
+    return n
+
+def _commit_batch():
+    if _db_ctx.transactions==0:
+        logging.info('auto commit')
+        _db_ctx.connection.commit()
+
+@with_connection
+def _insert_batches(head, cols, rows, batch_size):
+    global _db_ctx
+    one = '(%s)' % ','.join(['%s'] * len(cols))
+    total = 0
+    count = 0
+    size = len(head)
+    args = []
+    _db_ctx.wrote = True
+    cursor = _db_ctx.connection.cursor()
+    try:
+        for row in rows:
+            if len(row)!=len(cols):
+                raise DBError('Expect columns %s in every row.' % ','.join(cols))
+            try:
+                values = [row[col] for col in cols]
+            except KeyError:
+                raise DBError('Expect columns %s in every row.' % ','.join(cols))
+            n = _packet_size(values) + len(one) + 1
+            if count and (count >= batch_size or size + n > _max_packet):
+                total = total + _execute_batch(cursor, head, one, count, args)
+                count, size, args = 0, len(head), []
+            args.extend(values)
+            count = count + 1
+            size = size + n
+        if count:
+            total = total + _execute_batch(cursor, head, one, count, args)
+        return total
+    finally:
+        cursor.close()
+
+def _execute_batch(cursor, head, one, count, args):
+    sql = head + ','.join([one] * count)
+    logging.info('SQL: %s... (%d rows)' % (head, count))
+    cursor.execute(sql, args)
+    _commit_batch()
+    _invalidate(head)
+    return cursor.rowcount
+
+def insert_many(table, rows, batch_size=500):
+    '''
+    Insert rows (dicts with the same keys) into table with multi-row
+    insert statements of at most batch_size rows and max_packet bytes.
+    Outside a transaction every statement is committed on its own.
+    Return the total rowcount.
+
+    >>> insert_many('users', [])
+    0
+    '''
+    rows = iter(rows)
+    try:
+        first = next(rows)
+    except StopIteration:
+        return 0
+    cols = first.keys()
+    head = 'insert into `%s` (%s) values ' % (table, ','.join(['`%s`' % col for col in cols]))
+    return _insert_batches(head, cols, itertools.chain([first], rows), batch_size)
+
+@with_connection
+def update_many(sql, rows, batch_size=500):
+    '''
+    Execute sql once for every args sequence in rows, committing once
+    per batch_size rows outside a transaction. Return the total rowcount.
+
+    >>> update_many('update users set name=? where id=?', [])
+    0
+    '''
+    global _db_ctx
+    sql = _translate(sql)
+    total = 0
+    batch = []
+    cursor = None
+    _db_ctx.wrote = True
+    try:
+        for args in rows:
+            batch.append(tuple(args))
+            if len(batch) >= batch_size:
+                cursor = cursor or _db_ctx.connection.cursor()
+                total = total + _execute_many(cursor, sql, batch)
+                batch = []
+        if batch:
+            cursor = cursor or _db_ctx.connection.cursor()
+            total = total + _execute_many(cursor, sql, batch)
+        return total
+    finally:
+        if cursor:
+            cursor.close()
+
+def _execute_many(cursor, sql, batch):
+    logging.info('SQL: %s (%d rows)' % (sql, len(batch)))
+    cursor.executemany(sql, batch)
+    _commit_batch()
+    _invalidate(sql)
+    return cursor.rowcount
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
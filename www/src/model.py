@@ -5,13 +5,15 @@ import logging
 logging.basicConfig(format='%(levelname)s:%(message)s')
 import time,uuid
 from db import next_id
-from orm import Model,StringField,BooleanField,FloatField,TextField
+import search
+from orm import Model,Index,StringField,BooleanField,FloatField,TextField,VersionField,has_many,belongs_to
 
 class User(Model):
     '''
     >>> u = User()
     '''
     __table__ = 'users'
+    __indexes__ = [Index('email',unique=True),'created_at']
     id = StringField(primary_key=True,default=next_id,ddl='varchar(50)')
     email = StringField(updatable=False,ddl='varchar(50)')
     password = StringField(ddl='varchar(50)')
@@ -19,9 +21,13 @@ class User(Model):
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
     created_at = FloatField(updatable=False,default=time.time)
+    #listings of a user's blogs show no content, leave it deferred
+    blogs = has_many('Blog','user_id',order_by='created_at',columns=None)
 
 class Blog(Model):
     __table__ = 'blogs'
+    __counters__ = ('user_id',)
+    __indexes__ = [('user_id','created_at'),'created_at']
     id = StringField(primary_key=True,default=next_id,ddl='varchar(50)')
     user_id = StringField(updatable=False,ddl='varchar(50)')
     user_name = StringField(ddl='varchar(500)')
@@ -29,9 +35,20 @@ class Blog(Model):
     summary = StringField(ddl='varchar(200)')
     content = TextField()
     created_at = FloatField(updatable=False,default=time.time)
+    version = VersionField()
+    user = belongs_to('User','user_id')
+    comments = has_many('Comment','blog_id',order_by='created_at')
+    #提交后更新本进程的全文索引, 并记录到search_log让其他进程重放
+    def post_insert(self):
+        search.blogs_log.record(self.id,self)
+    post_update = post_insert
+    def post_delete(self):
+        search.blogs_log.record(self.id,None)
 
 class Comment(Model):
     __table__ = 'comments'
+    __counters__ = ('blog_id',)
+    __indexes__ = [('blog_id','created_at'),'user_id','created_at']
     id = StringField(primary_key=True,default=next_id,ddl='varchar(50)')
     blog_id = StringField(updatable=False, ddl='varchar(50)')
     user_id = StringField(updatable=False, ddl='varchar(50)')
@@ -39,6 +56,8 @@ class Comment(Model):
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
     created_at = FloatField(updatable=False, default=time.time)
+    blog = belongs_to('Blog', 'blog_id')
+    user = belongs_to('User', 'user_id')
 
 
 if __name__ == '__main__':
@@ -3,6 +3,11 @@
 
 import logging
 import time
+import re
+import threading
+import collections
+import base64
+import json
 import db
 
 class Field(object):
@@ -23,6 +28,8 @@ class Field(object):
         self.updatable = kw.get('updatable',True)
         self.insertable = kw.get('insertable',True)
         self.ddl = kw.get('ddl','')
+        #deferred fields are left out of find_* selects and loaded on first access
+        self.deferred = kw.get('deferred',False)
         self._order = Field._count
         Field._count = Field._count + 1
     @property
@@ -33,6 +40,7 @@ class Field(object):
         self.nullable and s.append('N')
         self.updatable and s.append('U')
         self.insertable and s.append('I')
+        self.deferred and s.append('D')
         s.append('>')
         return ''.join(s)
 
@@ -44,6 +52,17 @@ class StringField(Field):
             kw['ddl'] = 'varchar(255)'
         super(StringField,self).__init__(**kw)
 
+class IntegerField(Field):
+    '''
+    A bigint column, use default=db.next_int_id for integer primary keys.
+    '''
+    def __init__(self, **kw):
+        if not 'default' in kw:
+            kw['default'] = 0
+        if not 'ddl' in kw:
+            kw['ddl'] = 'bigint'
+        super(IntegerField, self).__init__(**kw)
+
 class FloatField(Field):
     def __init__(self, **kw):
         if not 'default' in kw:
@@ -64,6 +83,8 @@ class TextField(Field):
     def __init__(self, **kw):
         if not 'default' in kw:
             kw['default'] = ''
+        if not 'deferred' in kw:
+            kw['deferred'] = True
         if not 'ddl' in kw:
             kw['ddl'] = 'text'
         super(TextField, self).__init__(**kw)
@@ -72,15 +93,393 @@ class BlobField(Field):
     def __init__(self, **kw):
         if not 'default' in kw:
             kw['default'] = ''
+        if not 'deferred' in kw:
+            kw['deferred'] = True
         if not 'ddl' in kw:
             kw['ddl'] = 'blob'
         super(BlobField, self).__init__(**kw)
 
 class VersionField(Field):
+    '''
+    A row version for optimistic concurrency: update(), delete() and
+    save() only match the row still at the version the model was read at,
+    bump it in the same statement and raise ConflictError otherwise.
+    '''
     def __init__(self, name=None):
-        super(VersionField, self).__init__(name=name, default=0, ddl='bigint')
+        super(VersionField, self).__init__(name=name, default=0, ddl='bigint', updatable=False)
+
+class ConflictError(db.DBError):
+    '''
+    Raised when a versioned row was changed or deleted by someone else
+    since it was read.
+    '''
+    pass
+
+#the largest IN (...) list prefetch sends in one query
+_IN_CHUNK = 500
+
+#class name ==> model class, to resolve relations declared by name
+_models = {}
+
+class Relation(object):
+    '''
+    A relation to another model through a key field, declared on a Model
+    with has_many() or belongs_to(). Reading it on an instance loads it
+    with one query, prefetch() loads it for many instances at once.
+    columns is the select list of the related models as in find_by,
+    has_many() selects all fields by default so the deferred ones are not
+    loaded one query per model afterwards.
+
+    >>> r = has_many('Comment', 'blog_id', order_by='created_at')
+    >>> r.many, r.key, r.order_by, r.columns
+    (True, 'blog_id', 'created_at', '*')
+    '''
+    def __init__(self, model, key, many, order_by=None, columns=None):
+        self.model = model
+        self.key = key
+        self.many = many
+        self.order_by = order_by
+        self.columns = columns
+        self.name = None
+    def target(self):
+        if isinstance(self.model, basestring):
+            self.model = _models[self.model]
+        return self.model
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        related = obj._related()
+        if not self.name in related:
+            self.prefetch([obj])
+        return related[self.name]
+    def prefetch(self, objs):
+        '''
+        Load the related models of objs with one WHERE ... IN (...) query
+        per _IN_CHUNK keys and attach them to every obj.
+        '''
+        target = self.target()
+        if self.many:
+            src, dst = objs[0].__primary_key__.name, self.key
+        else:
+            src, dst = self.key, target.__primary_key__.name
+        keys = []
+        seen = set()
+        for obj in objs:
+            k = obj._peek(src)
+            if k is not None and not k in seen:
+                seen.add(k)
+                keys.append(k)
+        columns = self.columns
+        if columns is not None and columns!='*' and not dst in columns:
+            columns = list(columns) + [dst]
+        related = {}
+        for i in range(0, len(keys), _IN_CHUNK):
+            chunk = keys[i:i + _IN_CHUNK]
+            where = '`%s` in (%s)' % (dst, ','.join(['?'] * len(chunk)))
+            if self.order_by:
+                where = '%s order by `%s`' % (where, self.order_by)
+            for m in target.find_by(where, chunk, columns=columns):
+                if self.many:
+                    related.setdefault(m[dst], []).append(m)
+                else:
+                    related[m[dst]] = m
+        for obj in objs:
+            value = related.get(obj._peek(src))
+            obj._related()[self.name] = (value or []) if self.many else value
+
+def has_many(model, key, order_by=None, columns='*'):
+    '''
+    Declare the models whose field key holds the primary key of this one.
+
+    class Blog(Model):
+        comments = has_many('Comment', 'blog_id', order_by='created_at')
+    '''
+    return Relation(model, key, True, order_by, columns)
+
+def belongs_to(model, key, columns=None):
+    '''
+    Declare the model whose primary key is held by the field key of this one.
+
+    class Comment(Model):
+        user = belongs_to('User', 'user_id')
+    '''
+    return Relation(model, key, False, columns=columns)
+
+#pre_* run before the statement, post_* once it is committed
+_triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete', 'post_insert', 'post_update', 'post_delete'])
+
+#maintained row counts, see Model.count_all/count_by and createtable.sql
+_COUNTERS_TABLE = 'counters'
+_COUNT_BY = re.compile(r'^\s*`?(\w+)`?\s*=\s*\?\s*$')
+
+def _counter_key(table,column=None,value=None):
+    '''
+    Return the counters row name of a table, or of the rows of a table
+    having column=value.
+
+    >>> _counter_key('blogs'), _counter_key('comments', 'blog_id', 'a1')
+    ('blogs', 'comments.blog_id:a1')
+    '''
+    if column is None:
+        return table
+    return '%s.%s:%s' % (table,column,value)
+
+def reconcile_counters(*models):
+    '''
+    Recount the counters of models (all models declaring __counters__ by
+    default) from their tables, fixing any drift from writes made outside
+    the orm or from counts seeded while rows were being inserted.
+    '''
+    for cls in models or [m for m in _models.values() if m.__counters__ is not None]:
+        pk = cls.__primary_key__.name
+        key = _counter_key(cls.__table__)
+        prefixes = [_counter_key(cls.__table__,col,'').replace('_','\\_') + '%' for col in cls.__counters__]
+        with db.transaction():
+            #lock the counters (and the gaps between them) before counting:
+            #increments made meanwhile wait and land on the recount instead
+            #of being wiped by it, and the counts below read a snapshot that
+            #is only taken once the locks are held
+            db.select('select `name` from `%s` where `name`=?%s for update' % (_COUNTERS_TABLE,' or `name` like ?' * len(prefixes)),[key] + prefixes)
+            rows = [dict(name=key,value=db.select_int('select count(`%s`) from `%s`' % (pk,cls.__table__),cache=False))]
+            db.update('delete from `%s` where `name`=?' % _COUNTERS_TABLE,key)
+            for col,prefix in zip(cls.__counters__,prefixes):
+                for r in db.select('select `%s` as v,count(`%s`) as n from `%s` group by `%s`' % (col,pk,cls.__table__,col),cache=False):
+                    rows.append(dict(name=_counter_key(cls.__table__,col,r.v),value=r.n))
+                db.update('delete from `%s` where `name` like ?' % _COUNTERS_TABLE,prefix)
+            db.insert_many(_COUNTERS_TABLE,rows)
+
+def reconcile_every(seconds,*models):
+    '''
+    Start a daemon thread running reconcile_counters(*models) every
+    seconds, and return it.
+    '''
+    def run():
+        while True:
+            time.sleep(seconds)
+            try:
+                with db.connection():
+                    reconcile_counters(*models)
+            except Exception:
+                logging.exception('reconcile counters failed')
+    t = threading.Thread(target=run,name='reconcile-counters')
+    t.daemon = True
+    t.start()
+    return t
+
+class LocalCache(object):
+    '''
+    The default entity cache backend: an LRU mapping in this process.
+    Backends have get(key), set(key, value, ttl=None), add(key, value)
+    storing only if key holds nothing, and delete(key).
+
+    >>> c = LocalCache(ttl=60, size=2)
+    >>> c.set('users:1', {'id': '1'})
+    >>> c.get('users:1'), c.get('users:2')
+    ({'id': '1'}, None)
+    >>> c.add('users:1', {'id': '2'})
+    False
+    >>> c.delete('users:1')
+    >>> c.get('users:1') is None
+    True
+    '''
+    def __init__(self,ttl=None,size=10000):
+        self._lru = db._LRUCache(size,ttl)
+    def get(self,key):
+        return self._lru.get(key)
+    def set(self,key,value,ttl=None):
+        self._lru.put(key,value,ttl)
+    def add(self,key,value):
+        return self._lru.add(key,value)
+    def delete(self,key):
+        self._lru.pop(key)
+    def stats(self):
+        return self._lru.stats()
+
+class MemcacheCache(object):
+    '''
+    An entity cache backend shared across worker processes through a
+    memcache style client (python-memcached, pylibmc...): anything with
+    get(key), set(key, value, time), add(key, value, time) and delete(key).
+
+    mc = memcache.Client(['127.0.0.1:11211'])
+    orm.set_cache_backend(lambda ttl, size: orm.MemcacheCache(mc, ttl))
+    '''
+    def __init__(self,client,ttl=None,prefix='orm:'):
+        self._client = client
+        self._ttl = int(ttl or 0)
+        self._prefix = prefix
+    def get(self,key):
+        return self._client.get(self._prefix + key)
+    def set(self,key,value,ttl=None):
+        self._client.set(self._prefix + key,value,self._ttl if ttl is None else int(ttl))
+    def add(self,key,value):
+        return self._client.add(self._prefix + key,value,self._ttl)
+    def delete(self,key):
+        self._client.delete(self._prefix + key)
+
+#ttl, size ==> entity cache backend of a model declaring __cache__
+_cache_backend = LocalCache
+
+#what the entity cache holds for a row written less than _TOMBSTONE_TTL
+#seconds ago, so a read that started before the write cannot cache it back
+_TOMBSTONE = 'orm:tombstone'
+_TOMBSTONE_TTL = 10
+
+def set_cache_backend(factory):
+    '''
+    Set the factory(ttl, size) making the entity cache of the models that
+    declare __cache__ without a backend of their own. Models already
+    cached keep their backend.
+    '''
+    global _cache_backend
+    _cache_backend = factory
+
+#the abstract bases ModelMetaclass leaves alone
+_BASE_MODELS = frozenset(['_BaseModel', 'Model', 'SlotModel'])
+
+def _encode_cursor(values):
+    '''
+    Encode the sort key of the last row of a page as an opaque string.
+
+    >>> c = _encode_cursor([1500000000.25, u'0054f3a9b8c00001'])
+    >>> _decode_cursor(c)
+    [1500000000.25, u'0054f3a9b8c00001']
+    >>> _decode_cursor('bad')
+    Traceback (most recent call last):
+    ...
+    ValueError: Bad page cursor.
+    '''
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':'))).rstrip('=')
+
+def _decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError):
+        raise ValueError('Bad page cursor.')
+    if not isinstance(values, list) or len(values)!=2:
+        raise ValueError('Bad page cursor.')
+    return values
+
+class Index(object):
+    '''
+    A secondary index over one or more columns, declared in __indexes__:
+
+    class Comment(Model):
+        __indexes__ = ['user_id', ('blog_id', 'created_at'), Index('email', unique=True)]
 
-_triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
+    A column name or a tuple of them is an Index with the default name.
+
+    >>> Index('blog_id', 'created_at')
+    <Index:idx_blog_id_created_at(blog_id,created_at)>
+    '''
+    def __init__(self,*columns,**kw):
+        if not columns:
+            raise TypeError('Index needs at least one column')
+        self.columns = tuple(columns)
+        self.unique = kw.get('unique',False)
+        self.name = kw.get('name') or 'idx_' + '_'.join(columns)
+    def ddl(self):
+        return '%skey `%s` (%s)' % ('unique ' if self.unique else '',self.name,','.join(['`%s`' % c for c in self.columns]))
+    def __str__(self):
+        return '<Index:%s(%s)%s>' % (self.name,','.join(self.columns),' unique' if self.unique else '')
+    __repr__ = __str__
+
+def _index(spec):
+    if isinstance(spec,Index):
+        return spec
+    if isinstance(spec,basestring):
+        return Index(spec)
+    return Index(*spec)
+
+def _gen_sql(table, mappings, indexes=()):
+    '''
+    Generate the CREATE TABLE statement from the ddl of the fields and
+    the declared indexes.
+
+    >>> print _gen_sql('tags', {'id': StringField(name='id', primary_key=True, nullable=False, ddl='varchar(50)'), 'name': StringField(name='name')}, [Index('name', unique=True)])
+    -- generating SQL for tags:
+    create table `tags` (
+      `id` varchar(50) not null,
+      `name` varchar(255),
+      unique key `idx_name` (`name`),
+      primary key(`id`)
+    ) engine=innodb default charset=utf8;
+    '''
+    pk = None
+    sql = ['-- generating SQL for %s:' % table, 'create table `%s` (' % table]
+    for f in sorted(mappings.values(), key=lambda f: f._order):
+        if not f.ddl:
+            raise StandardError('no ddl in field "%s".' % f.name)
+        if f.primary_key:
+            pk = f.name
+        sql.append('  `%s` %s%s,' % (f.name, f.ddl, '' if f.nullable else ' not null'))
+    for index in indexes:
+        sql.append('  %s,' % index.ddl())
+    sql.append('  primary key(`%s`)' % pk)
+    sql.append(') engine=innodb default charset=utf8;')
+    return '\n'.join(sql)
+
+#dev mode: warn about finders filtering on columns no index starts with
+_check_indexes = False
+_warned = set()
+_RE_WHERE_COLUMN = re.compile(r'`?(\w+)`?\s*(?:=|<|>|!=|<>|\bin\b|\blike\b|\bbetween\b|\bis\b)', re.IGNORECASE)
+_RE_WHERE_TAIL = re.compile(r'\b(?:order\s+by|group\s+by|limit)\b.*$', re.IGNORECASE | re.DOTALL)
+
+def check_indexes(enabled=True):
+    '''
+    Turn on (or off) the dev mode check of find_by/find_first where
+    clauses against the declared indexes.
+    '''
+    global _check_indexes
+    _check_indexes = enabled
+    _warned.clear()
+
+def _where_columns(cls,where):
+    '''
+    Return the fields a where clause filters on.
+
+    >>> class Tag(Model):
+    ...     id = StringField(primary_key=True)
+    ...     name = StringField()
+    ...     created_at = FloatField()
+    >>> sorted(_where_columns(Tag, 'where `name`=? and created_at > ? order by created_at'))
+    ['created_at', 'name']
+    '''
+    where = _RE_WHERE_TAIL.sub('',where)
+    return frozenset([c for c in _RE_WHERE_COLUMN.findall(where) if c in cls.__mappings__])
+
+def _check_where(cls,where):
+    columns = _where_columns(cls,where)
+    if not columns or (cls,columns) in _warned:
+        return
+    if cls.__primary_key__.name in columns or [i for i in cls.__indexes__ if i.columns[0] in columns]:
+        return
+    _warned.add((cls,columns))
+    logging.warning('<class:%s> no index covers %s: %s' % (cls.__name__,', '.join(sorted(columns)),where))
+
+def _compile_sql(attrs):
+    '''
+    Build the statements of a model class once, with a fixed column order,
+    so the instance methods only bind values.
+    '''
+    table = attrs['__table__']
+    mappings = attrs['__mappings__']
+    pk = attrs['__primary_key__'].name
+    columns = attrs['__columns__']
+    attrs['__insert_columns__'] = tuple([k for k in columns if mappings[k].insertable])
+    attrs['__update_columns__'] = tuple([k for k in columns if mappings[k].updatable])
+    attrs['__get_sql__'] = 'select * from `%s` where `%s`=?' % (table, pk)
+    attrs['__insert_sql__'] = 'insert into `%s` (%s) values (%s)' % (table,
+        ','.join(['`%s`' % k for k in attrs['__insert_columns__']]), ','.join(['?'] * len(attrs['__insert_columns__'])))
+    versions = [k for k in columns if isinstance(mappings[k], VersionField)]
+    if len(versions) > 1:
+        raise TypeError('Cannot define more than 1 VersionField in table %s' % table)
+    version = attrs['__version__'] = versions[0] if versions else None
+    attrs['__delete_sql__'] = 'delete from `%s` where `%s`=?%s' % (table, pk, ' and `%s`=?' % version if version else '')
+    #tuple of columns ==> update statement setting them, filled on use
+    attrs['__update_sql__'] = {}
+    #tuple of columns ==> insert statement updating them on a duplicate key, filled on use
+    attrs['__save_sql__'] = {}
 
 class ModelMetaclass(type):
     '''
@@ -108,7 +507,7 @@ class ModelMetaclass(type):
     <StringField:name,varchar(255),default(),I>
     '''
     def __new__(cls,name,bases,attrs):
-        if name == 'Model':
+        if name in _BASE_MODELS:
             return type.__new__(cls,name,bases,attrs)
         #注意cls表示当前类，所以cls.subclasses是当前类的属性
         #即ModelMetaclass的属性，而不是实例属性
@@ -120,8 +519,12 @@ class ModelMetaclass(type):
             logging.warning('Redefine class: %s' % name)
         logging.info('Scan ORMapping %s...' % name)
         mappings = {}
+        relations = {}
         primary_key = None
         for key,value in attrs.iteritems():
+            if isinstance(value,Relation):
+                value.name = key
+                relations[key] = value
             if isinstance(value,Field):
                 if not value.name:
                     value.name = key
@@ -147,80 +550,847 @@ class ModelMetaclass(type):
         if not '__table__' in attrs:
             attrs['__table__'] = name.lower()
         attrs['__mappings__'] = mappings
+        attrs['__relations__'] = relations
         attrs['__primary_key__'] = primary_key
-        attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'],mappings)
+        attrs['__columns__'] = sorted(mappings.iterkeys(),key=lambda k: mappings[k]._order)
+        attrs['__select__'] = ','.join(['`%s`' % k for k in attrs['__columns__'] if not mappings[k].deferred])
+        attrs['__indexes__'] = [_index(spec) for spec in attrs.get('__indexes__',())]
+        for index in attrs['__indexes__']:
+            for col in index.columns:
+                if not col in mappings:
+                    raise TypeError('Index column %s is not a field of %s' % (col,name))
+        _compile_sql(attrs)
         for trigger in _triggers:
             if not trigger in attrs:
                 attrs[trigger] = None
-        return type.__new__(cls,name,bases,attrs)
+        if '__counters__' in attrs:
+            attrs['__counters__'] = tuple(attrs['__counters__'])
+            for col in attrs['__counters__']:
+                if not col in mappings:
+                    raise TypeError('Counter column %s is not a field of %s' % (col,name))
+        else:
+            attrs['__counters__'] = None
+        attrs['__cache__'] = dict(attrs['__cache__']) if attrs.get('__cache__') else None
+        attrs['__entity_cache__'] = None
+        if [b for b in bases if getattr(b,'__compact__',False)]:
+            attrs['__slots__'] = tuple(attrs['__columns__']) + ('_loaded','_rel')
+            #row column names ==> slot setters by position, see SlotModel._hydrate
+            attrs['__plans__'] = {}
+        _models[name] = type.__new__(cls,name,bases,attrs)
+        return _models[name]
 
-class Model(dict):
+class _BaseModel(object):
+    '''
+    The queries and write methods shared by Model and SlotModel, written
+    against the mapping protocol and a few storage hooks: _get_loaded,
+    _set_loaded, _snapshot, _related, _peek and _hydrate.
+    '''
     __metaclass__ = ModelMetaclass
-    def __init__(self,**kw):
-        super(Model,self).__init__(**kw)
-    def __getattr__(self,key):
-        try:
-            return self[key]
-        except KeyError:
-            raise AttributeError(r"'Dict' object has no attribute %s" % key)
-    def __setattr__(self,key,value):
-        self[key]=value
+    __slots__ = ()
+    def _load_missing(self,key):
+        '''
+        Load the columns a find_* left out, all in one query, when one of
+        them is first read from a model that came from the db.
+        '''
+        loaded = self._get_loaded()
+        if not key in self.__mappings__ or loaded is None:
+            raise KeyError(key)
+        pk = self.__primary_key__.name
+        missing = [k for k in self.__columns__ if not k in self]
+        row = db.select_one('select %s from `%s` where `%s`=?' % (','.join(['`%s`' % k for k in missing]),self.__table__,pk),[self[pk]])
+        if row is None:
+            raise KeyError(key)
+        for k in missing:
+            self[k] = loaded[k] = row[k]
+        return self[key]
+    @classmethod
+    def _columns(cls,columns):
+        '''
+        Return the select list for columns, None for the non deferred
+        fields and '*' for all of them. The primary key is always added.
+        '''
+        if columns is None:
+            return cls.__select__
+        if columns=='*':
+            return '*'
+        pk = cls.__primary_key__.name
+        for col in columns:
+            if not col in cls.__mappings__:
+                raise ValueError('%s has no field %s' % (cls.__name__,col))
+        if not pk in columns:
+            columns = [pk] + list(columns)
+        return ','.join(['`%s`' % col for col in columns])
+    @classmethod
+    def ddl(cls):
+        '''
+        Return the CREATE TABLE statement of the model.
+
+        >>> class Tag(Model):
+        ...     id = StringField(primary_key=True, ddl='varchar(50)')
+        ...     name = StringField(ddl='varchar(50)')
+        >>> print Tag.ddl()
+        -- generating SQL for tag:
+        create table `tag` (
+          `id` varchar(50) not null,
+          `name` varchar(50),
+          primary key(`id`)
+        ) engine=innodb default charset=utf8;
+        '''
+        return _gen_sql(cls.__table__,cls.__mappings__,cls.__indexes__)
+    __sql__ = ddl
+    @classmethod
+    def _load(cls,d):
+        '''
+        Make a model from a row. Inside a connection scope the instance
+        already loaded for the same primary key is returned instead.
+        '''
+        identity = db.identity_map()
+        if identity is None:
+            return cls._hydrate(d)
+        key = (cls,d[cls.__primary_key__.name])
+        obj = identity.get(key)
+        if obj is None:
+            obj = identity[key] = cls._hydrate(d)
+        return obj
+    def _mark_clean(self):
+        '''
+        Remember the column values as stored, update() sends only the
+        columns that differ from them.
+        '''
+        self._set_loaded(self._snapshot())
+        return self
+    def dirty_fields(self):
+        '''
+        Return the names of the updatable fields changed since the model
+        was loaded or saved, or None if it was not loaded from the db.
+
+        >>> class Tag(Model):
+        ...     id = StringField(primary_key=True)
+        ...     name = StringField()
+        >>> t = Tag(id='1', name='python')._mark_clean()
+        >>> t.dirty_fields()
+        []
+        >>> t.name = 'ruby'
+        >>> t.dirty_fields()
+        ['name']
+        >>> Tag(id='2').dirty_fields() is None
+        True
+        '''
+        loaded = self._get_loaded()
+        if loaded is None:
+            return None
+        return [k for k,f in self.__mappings__.iteritems() if f.updatable and k in self and (not k in loaded or loaded[k]!=self[k])]
+    def _forget(self):
+        identity = db.identity_map()
+        if identity is not None:
+            identity.pop((self.__class__,self[self.__primary_key__.name]),None)
+    @classmethod
+    def query(cls):
+        '''
+        Return a lazy QuerySet on this model.
+
+        users = User.query().filter(admin=True).order_by('-created_at').limit(20)
+        '''
+        return QuerySet(cls)
+    @classmethod
+    def prefetch(cls,objs,*names):
+        '''
+        Load the named relations for all objs, one query per relation.
+
+        Blog.prefetch(blogs, 'comments', 'user')
+        '''
+        objs = [obj for obj in objs if obj is not None]
+        if objs:
+            for name in names:
+                if not name in cls.__relations__:
+                    raise ValueError('%s has no relation %s' % (cls.__name__,name))
+                cls.__relations__[name].prefetch(objs)
+        return objs
     @classmethod
     def get(cls,pk):
-        item = db.select_one('select * from `%s` where %s=?' % (cls.__table__,cls.primary_key__.name), pk)
-        return cls(**item) if item else None
+        '''
+        Return the model with primary key pk, or None. A model declaring
+
+        class User(Model):
+            __cache__ = dict(ttl=60, size=10000)
+
+        reads the row from its entity cache first, outside transactions.
+        Misses are read from the primary, a replica may lag behind.
+        update() and delete() replace the entry with a tombstone once
+        they are committed, and the row is not cached again until it
+        expires: a read racing the write could hold the old row.
+        '''
+        identity = db.identity_map()
+        if identity is not None and (cls,pk) in identity:
+            return identity[(cls,pk)]
+        cache = cls.__cache__ and not db.in_transaction() and cls._entity_cache()
+        if not cache:
+            item = db.select_one(cls.__get_sql__, [pk])
+            return cls._load(item) if item else None
+        key = '%s:%s' % (cls.__table__,pk)
+        item = cache.get(key)
+        if item is None or item==_TOMBSTONE:
+            row = db.select_one(cls.__get_sql__, [pk], primary=True)
+            if not row:
+                return None
+            row = dict(zip(*db.row_tuple(row)))
+            if item is None:
+                #add() keeps a tombstone a write committed meanwhile
+                cache.add(key,row)
+            item = row
+        return cls._load(item)
     @classmethod
-    def find_first(cls,where,*args):
-        item = db.select_one('select * from `%s` %s' % (cls.__table__,where),*args)
-        return cls(**item) if item else None
+    def _entity_cache(cls):
+        cache = cls.__entity_cache__
+        if cache is None:
+            options = dict(cls.__cache__)
+            factory = options.pop('backend',None) or _cache_backend
+            cache = cls.__entity_cache__ = factory(options.get('ttl'),options.get('size',10000))
+        return cache
+    def _uncache(self):
+        #tombstone the cached row once the write is committed, not before
+        if self.__cache__:
+            cache = self._entity_cache()
+            key = '%s:%s' % (self.__table__,self[self.__primary_key__.name])
+            db.on_commit(lambda: cache.set(key,_TOMBSTONE,_TOMBSTONE_TTL))
     @classmethod
-    def find_all(cls,*args):
-        items = db.select('select * from `%s`' % cls.__table__)
-        return [cls(**d) for d in items]
+    def find_first(cls,where,*args,**kw):
+        '''
+        Return the first model matching where, like find_by.
+        '''
+        _check_indexes and _check_where(cls,where)
+        item = db.select_one('select %s from `%s` %s' % (cls._columns(kw.get('columns')),cls.__table__,where),*args)
+        if not item:
+            return None
+        obj = cls._load(item)
+        cls.prefetch([obj],*kw.get('prefetch',()))
+        return obj
     @classmethod
-    def find_by(cls,where,*args):
-        items = db.select('select * from `%s` where %s' % (cls.__table__,where),*args)
-        return [cls(**d) for d in items]
+    def find_all(cls,*args,**kw):
+        '''
+        Return all models, like find_by.
+        '''
+        items = db.select('select %s from `%s`' % (cls._columns(kw.get('columns')),cls.__table__))
+        return cls.prefetch([cls._load(d) for d in items],*kw.get('prefetch',()))
+    @classmethod
+    def find_by(cls,where,*args,**kw):
+        '''
+        Return the models matching where. Deferred fields (TextField and
+        BlobField by default) are not selected and get loaded on first
+        access; pass columns=[...] to select only some fields or
+        columns='*' for all of them. prefetch=('comments', 'user') loads
+        the named relations of all results, one query per relation.
+
+        blogs = Blog.find_by('user_id=?', [uid], columns=['name', 'summary'])
+        '''
+        _check_indexes and _check_where(cls,where)
+        items = db.select('select %s from `%s` where %s' % (cls._columns(kw.get('columns')),cls.__table__,where),*args)
+        return cls.prefetch([cls._load(d) for d in items],*kw.get('prefetch',()))
+    @classmethod
+    def find_page(cls,order_by='created_at',after=None,limit=20,where=None,args=(),columns=None,prefetch=()):
+        '''
+        Return (models, cursor) for one page ordered by order_by, '-' in
+        front for descending, then by primary key. Pass the cursor as
+        after to get the next page, it is None on the last page. Pages
+        seek on (order_by, primary key) instead of using an offset.
+        limit must be at least 1. columns and prefetch work as in find_by.
+
+        blogs, cursor = Blog.find_page('-created_at', after=request.get('page'))
+        '''
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError('Bad page limit: %s' % limit)
+        desc = order_by.startswith('-')
+        col = order_by[1:] if desc else order_by
+        if not col in cls.__mappings__:
+            raise ValueError('Cannot order %s by %s' % (cls.__name__,col))
+        pk = cls.__primary_key__.name
+        conds = ['(%s)' % where] if where else []
+        params = list(args)
+        if after is not None:
+            value,last = _decode_cursor(after)
+            op = '<' if desc else '>'
+            conds.append('(`%s` %s ? or (`%s` = ? and `%s` %s ?))' % (col,op,col,pk,op))
+            params.extend([value,value,last])
+        direction = 'desc' if desc else 'asc'
+        if columns is not None and columns!='*' and not col in columns:
+            columns = [col] + list(columns)
+        sql = 'select %s from `%s`%s order by `%s` %s, `%s` %s limit %d' % (cls._columns(columns),cls.__table__,
+              ' where ' + ' and '.join(conds) if conds else '',col,direction,pk,direction,limit + 1)
+        items = [cls._load(d) for d in db.select(sql,params)]
+        if len(items) <= limit:
+            return cls.prefetch(items,*prefetch),None
+        items = cls.prefetch(items[:limit],*prefetch)
+        return items,_encode_cursor([getattr(items[-1],col),getattr(items[-1],pk)])
+    @classmethod
+    def iter_by(cls,where,*args,**kw):
+        '''
+        Like find_by but yield the models one by one from db.iter_select,
+        chunk_size is passed through. Lazy loads in the loop run on the
+        connection of the current scope, or of one opened for the loop,
+        while the rows stream on a connection of their own outside a
+        transaction.
+        '''
+        sql = 'select %s from `%s` where %s' % (cls._columns(kw.pop('columns',None)),cls.__table__,where)
+        with db.connection():
+            for d in db.iter_select(sql,*args,**kw):
+                yield cls._hydrate(d)
     @classmethod
     def count_all(cls):
-        return db.select_int('select count (%s) from `%s`' % (cls.__primary_key__.name,cls.__table))
+        '''
+        Return the number of rows, from the counters table when the model
+        declares __counters__.
+        '''
+        sql = 'select count(`%s`) from `%s`' % (cls.__primary_key__.name,cls.__table__)
+        if cls.__counters__ is None:
+            return db.select_int(sql)
+        return cls._counted(_counter_key(cls.__table__),sql,())
+    @classmethod
+    def count_by(cls,where,*args):
+        '''
+        Return the number of rows matching where. The 'column=?' form is
+        read from the counters table for the columns in __counters__:
+
+        class Comment(Model):
+            __counters__ = ('blog_id',)
+
+        Comment.count_by('blog_id=?', [blog_id])
+        '''
+        sql = 'select count(`%s`) from `%s` where %s' % (cls.__primary_key__.name,cls.__table__,where)
+        m = cls.__counters__ and args and _COUNT_BY.match(where)
+        if m and m.group(1) in cls.__counters__:
+            return cls._counted(_counter_key(cls.__table__,m.group(1),args[0][0]),sql,args)
+        return db.select_int(sql,*args)
+    conut_by = count_by
     @classmethod
-    def conut_by(cls,where,*args):
-        return db.select_int('select count (%s) form `%s` %s' % (cls.__primary_key.name,cls.__table__,where), *args)
+    def _counted(cls,key,sql,args):
+        #a missing counter is seeded from a scan, reconcile_counters fixes races
+        r = db.select_one('select `value` from `%s` where `name`=?' % _COUNTERS_TABLE,[key],primary=True,cache=False)
+        if r is not None:
+            return r.value
+        n = db.select_int(sql,*args,primary=True,cache=False)
+        db.update('insert ignore into `%s` (`name`,`value`) values (?,?)' % _COUNTERS_TABLE,key,n)
+        return n
+    @classmethod
+    def _count_rows(cls,rows,delta,columns=None):
+        '''
+        Add delta per row of rows (models or dicts of their fields) to the
+        counters, or only to those of columns, one statement per counter.
+        '''
+        counts = collections.defaultdict(int)
+        for row in rows:
+            if columns is None:
+                counts[_counter_key(cls.__table__)] += delta
+            for col in cls.__counters__ if columns is None else columns:
+                counts[_counter_key(cls.__table__,col,row[col])] += delta
+        sql = 'update `%s` set `value`=`value`+? where `name`=?' % _COUNTERS_TABLE
+        for key,n in counts.iteritems():
+            if n:
+                db.update(sql,n,key)
+    @classmethod
+    def _update_sql(cls,columns):
+        sql = cls.__update_sql__.get(columns)
+        if sql is None:
+            sets = ['`%s`=?' % k for k in columns]
+            where = '`%s`=?' % cls.__primary_key__.name
+            if cls.__version__:
+                sets.append('`%s`=`%s`+1' % (cls.__version__,cls.__version__))
+                where = '%s and `%s`=?' % (where,cls.__version__)
+            sql = cls.__update_sql__[columns] = 'update `%s` set %s where %s' % (cls.__table__,','.join(sets),where)
+        return sql
+    @classmethod
+    def _save_sql(cls,columns):
+        sql = cls.__save_sql__.get(columns)
+        if sql is None:
+            version = cls.__version__
+            if version:
+                #mysql assigns left to right, so the version is compared before it is bumped
+                updates = ['`%s`=if(`%s`=values(`%s`),values(`%s`),`%s`)' % (k, version, version, k, k) for k in columns]
+                updates.append('`%s`=if(`%s`=values(`%s`),`%s`+1,`%s`)' % (version, version, version, version, version))
+            else:
+                pk = cls.__primary_key__.name
+                updates = ['`%s`=values(`%s`)' % (k, k) for k in columns] or ['`%s`=`%s`' % (pk, pk)]
+            sql = cls.__save_sql__[columns] = '%s on duplicate key update %s' % (cls.__insert_sql__, ','.join(updates))
+        return sql
+    def _versioned(self,args):
+        #the args of a statement matching the row at the version read
+        version = self.__version__
+        if version:
+            if not version in self:
+                self[version] = self.__mappings__[version].default
+            args.append(self[version])
+        return args
+    def _check_version(self,rowcount,what):
+        version = self.__version__
+        if version and not rowcount:
+            raise ConflictError('%s %s=%s at %s=%s was changed or deleted by someone else, %s failed' % (
+                self.__table__,self.__primary_key__.name,self[self.__primary_key__.name],version,self[version],what))
     def update(self):
+        '''
+        Write the updatable fields back. A model loaded from the db sends
+        only the changed columns, and nothing at all if none changed.
+
+        With a VersionField the statement also bumps the version and only
+        matches the row at the version read, raising ConflictError if
+        someone else changed it first:
+
+        update `blogs` set `name`=?,`version`=`version`+1 where `id`=? and `version`=?
+        '''
         self.pre_update and self.pre_update()
-        items = []
+        loaded = self._get_loaded()
+        if loaded is None:
+            columns = self.__update_columns__
+            for key in columns:
+                if not key in self:
+                    self[key] = self.__mappings__[key].default
+        else:
+            #the dirty fields, in the column order the statements are cached by
+            columns = tuple([k for k in self.__update_columns__ if k in self and (not k in loaded or loaded[k]!=self[k])])
+            if not columns:
+                return self
+        args = [self[k] for k in columns]
+        args.append(self[self.__primary_key__.name])
+        self._versioned(args)
+        moved = loaded is not None and self.__counters__ and [k for k in columns if k in self.__counters__]
+        if moved:
+            with db.transaction():
+                self._check_version(db.update(self._update_sql(columns),*args),'update')
+                self._count_rows([loaded],-1,moved)
+                self._count_rows([self],1,moved)
+        else:
+            self._check_version(db.update(self._update_sql(columns),*args),'update')
+        if self.__version__:
+            self[self.__version__] = self[self.__version__] + 1
+        self._uncache()
+        self._forget()
+        self._mark_clean()
+        self.post_update and db.on_commit(self.post_update)
+        return self
+    def _insert_args(self,trigger=True):
+        trigger and self.pre_insert and self.pre_insert()
         args = []
-        for key,value in self.__mappings__.iteritems():
-            if value.updatable:
-                if hasattr(self,key):
-                    arg = getattr(self,key)
-                else:
-                    arg = value.default
-                    setattr(self,key,value)
-                items.append('%s = ?' % key)
-                args.append(arg)
-        pk = self.__primary_key__.name
-        args.append(getattr(self,pk))
-        db.update('update `%s` set %s where %s = ?' % (self.__table__,','.join(items),pk),*args)
+        for key in self.__insert_columns__:
+            if not key in self:
+                self[key] = self.__mappings__[key].default
+            args.append(self[key])
+        return args
+    def save(self):
+        '''
+        Insert the model, or update the updatable fields of the row with
+        the same primary (or unique) key, in one statement:
+
+        insert into ... values (...) on duplicate key update `name`=values(`name`),...
+
+        pre_insert is called for a new model and pre_update for one loaded
+        from the db. A model not loaded from the db only updates the
+        columns set on it, the defaults filled in for the insert do not
+        overwrite the row. With a VersionField the existing row is only
+        updated at the version of the model, else ConflictError is raised.
+        '''
+        if self._get_loaded() is None:
+            self.pre_insert and self.pre_insert()
+            columns = tuple([k for k in self.__update_columns__ if k in self])
+            args = self._insert_args(False)
+        else:
+            columns = self.__update_columns__
+            self.pre_update and self.pre_update()
+            missing = [k for k in self.__insert_columns__ if not k in self]
+            if missing:
+                #load deferred fields rather than overwrite them with defaults
+                self._load_missing(missing[0])
+            args = self._insert_args(False)
+        #mysql counts 1 for an inserted row, 2 for an updated one and 0
+        #for a row left unchanged, which a versioned save means a conflict
+        sql = self._save_sql(columns)
+        if self.__counters__ is None:
+            r = db.update(sql,*args)
+        else:
+            with db.transaction():
+                r = db.update(sql,*args)
+                if r == 1:
+                    self._count_rows([self],1)
+        self._check_version(r,'save')
+        if self.__version__ and r == 2:
+            self[self.__version__] = self[self.__version__] + 1
+        self._uncache()
+        self._forget()
+        self._mark_clean()
+        trigger = self.post_insert if r == 1 else self.post_update
+        trigger and db.on_commit(trigger)
         return self
+    @classmethod
+    def insert_many(cls,objs,batch_size=500):
+        '''
+        Insert the models objs with multi-row insert statements of at most
+        batch_size rows, after calling pre_insert and filling defaults of
+        each. Return the number of inserted rows.
+        '''
+        objs = list(objs)
+        rows = [dict(zip(cls.__insert_columns__,obj._insert_args())) for obj in objs]
+        if cls.__counters__ is None:
+            n = db.insert_many(cls.__table__,rows,batch_size)
+        else:
+            with db.transaction():
+                n = db.insert_many(cls.__table__,rows,batch_size)
+                cls._count_rows(rows,1)
+        for obj in objs:
+            obj._mark_clean()
+            obj.post_insert and db.on_commit(obj.post_insert)
+        return n
     def insert(self):
-        self.pre_insert and self.pre_insert()
-        params = {}
-        for key,value in self.__mappings__.iteritems():
-            if value.insertable:
-                if not hasattr(self,key):
-                    setattr(self,key,value.default)
-                params[value.name] = getattr(self,key)
-        db.insert('%s' % self.__table__,**params)
+        args = self._insert_args()
+        if self.__counters__ is None:
+            db.update(self.__insert_sql__,*args)
+        else:
+            with db.transaction():
+                db.update(self.__insert_sql__,*args)
+                self._count_rows([self],1)
+        self._mark_clean()
+        self.post_insert and db.on_commit(self.post_insert)
         return self
     def delete(self):
         self.pre_delete and self.pre_delete()
-        pd = self.__primary_key__.name
-        args = (getattr(self,pk),)
-        db.update('delete from `%s` where %s = ?' % (self.__table__,pk),*args)
+        args = self._versioned([self[self.__primary_key__.name]])
+        if self.__counters__ is None:
+            self._check_version(db.update(self.__delete_sql__,*args),'delete')
+        else:
+            with db.transaction():
+                r = db.update(self.__delete_sql__,*args)
+                self._check_version(r,'delete')
+                if r:
+                    self._count_rows([self],-1)
+        self._uncache()
+        self._forget()
+        self.post_delete and db.on_commit(self.post_delete)
         return self
 
+class Model(_BaseModel, dict):
+    '''
+    A model stored as a dict of its fields, also read as attributes.
+    '''
+    #the snapshot of the stored values lives in a slot, so a hydrated
+    #model has no instance __dict__ until a relation is attached to it
+    __slots__ = ('_loaded',)
+    def __init__(self,**kw):
+        super(Model,self).__init__(**kw)
+    def __getattr__(self,key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(r"'Dict' object has no attribute %s" % key)
+    def __setattr__(self,key,value):
+        self[key]=value
+    def __missing__(self,key):
+        return self._load_missing(key)
+    def _get_loaded(self):
+        try:
+            loaded = object.__getattribute__(self,'_loaded')
+        except AttributeError:
+            return None
+        if isinstance(loaded,tuple):
+            #hydrated rows keep (names, values) until the snapshot is needed
+            loaded = dict(zip(*loaded))
+            object.__setattr__(self,'_loaded',loaded)
+        return loaded
+    def _set_loaded(self,loaded):
+        object.__setattr__(self,'_loaded',loaded)
+    def _snapshot(self):
+        return dict(self)
+    def _related(self):
+        return self.__dict__
+    def _peek(self,key):
+        return dict.get(self,key)
+    @classmethod
+    def _hydrate(cls,d):
+        obj = cls.__new__(cls)
+        names,values = db.row_tuple(d)
+        if isinstance(d,dict):
+            dict.update(obj,d)
+        else:
+            dict.update(obj,zip(names,values))
+        object.__setattr__(obj,'_loaded',(names,values))
+        return obj
+
+class SlotModel(_BaseModel):
+    '''
+    A compact alternative to Model: the metaclass turns the fields into
+    __slots__, so there is no dict per instance, and rows are hydrated
+    by position. Fields read as m.name or m['name'] like with Model, but
+    only fields can be set.
+
+    >>> class Note(SlotModel):
+    ...     id = StringField(primary_key=True)
+    ...     text = StringField()
+    >>> n = Note(id='1')
+    >>> n.text = 'hi'
+    >>> n['text'], n.id, 'text' in n, n.keys()
+    ('hi', '1', True, ['id', 'text'])
+    >>> n2 = Note._hydrate(db.Row(db._Schema(['text', 'id']), ('hello', '2')))
+    >>> n2
+    {'id': '2', 'text': 'hello'}
+    >>> n2.text = 'bye'
+    >>> n2.dirty_fields()
+    ['text']
+    >>> n.title = 'x'
+    Traceback (most recent call last):
+    ...
+    AttributeError: 'Note' object has no attribute 'title'
+    '''
+    __slots__ = ()
+    __compact__ = True
+    def __init__(self,**kw):
+        for key,value in kw.iteritems():
+            self[key] = value
+    def __getattr__(self,key):
+        #only called for fields not set yet, which may be deferred
+        if key in self.__mappings__:
+            try:
+                return self._load_missing(key)
+            except KeyError:
+                pass
+        raise AttributeError(r"'%s' object has no attribute %s" % (self.__class__.__name__,key))
+    def __getitem__(self,key):
+        if not key in self.__mappings__:
+            raise KeyError(key)
+        try:
+            return getattr(self,key)
+        except AttributeError:
+            raise KeyError(key)
+    def __setitem__(self,key,value):
+        if not key in self.__mappings__:
+            raise KeyError(key)
+        object.__setattr__(self,key,value)
+    def __contains__(self,key):
+        return key in self.__mappings__ and self._peek(key,_UNSET) is not _UNSET
+    def iterkeys(self):
+        for key in self.__columns__:
+            if self._peek(key,_UNSET) is not _UNSET:
+                yield key
+    __iter__ = iterkeys
+    def iteritems(self):
+        for key in self.iterkeys():
+            yield key,object.__getattribute__(self,key)
+    def keys(self):
+        return list(self.iterkeys())
+    def values(self):
+        return [v for k,v in self.iteritems()]
+    def items(self):
+        return list(self.iteritems())
+    def __len__(self):
+        return len(self.keys())
+    def __eq__(self,other):
+        return isinstance(other,(dict,SlotModel)) and dict(self.iteritems())==dict(other.iteritems())
+    def __ne__(self,other):
+        return not self==other
+    def __repr__(self):
+        return '{%s}' % ', '.join(['%r: %r' % (k,v) for k,v in self.iteritems()])
+    __str__ = __repr__
+    def _peek(self,key,default=None):
+        try:
+            return object.__getattribute__(self,key)
+        except AttributeError:
+            return default
+    def _get_loaded(self):
+        loaded = self._peek('_loaded')
+        if isinstance(loaded,tuple):
+            #hydrated rows keep (names, values) until the snapshot is needed
+            names,values = loaded
+            loaded = dict([(n,v) for n,v in zip(names,values) if n in self.__mappings__])
+            object.__setattr__(self,'_loaded',loaded)
+        return loaded
+    def _set_loaded(self,loaded):
+        object.__setattr__(self,'_loaded',loaded)
+    def _snapshot(self):
+        return dict(self.iteritems())
+    def _related(self):
+        related = self._peek('_rel')
+        if related is None:
+            related = {}
+            object.__setattr__(self,'_rel',related)
+        return related
+    @classmethod
+    def _hydrate(cls,d):
+        names,values = db.row_tuple(d)
+        plan = cls.__plans__.get(names)
+        if plan is None:
+            plan = cls.__plans__[names] = [(getattr(cls,n).__set__,i) for i,n in enumerate(names) if n in cls.__mappings__]
+        obj = cls.__new__(cls)
+        for set_value,i in plan:
+            set_value(obj,values[i])
+        object.__setattr__(obj,'_loaded',(names,values))
+        return obj
+
+_UNSET = object()
+
+_LOOKUPS = dict(eq='=',ne='<>',gt='>',gte='>=',lt='<',lte='<=')
+
+class QuerySet(object):
+    '''
+    A lazy query on a model. Chained calls return new query sets and
+    nothing is sent to the db until it is iterated (streamed from
+    db.iter_select in chunks), or count(), exists() or first() is called.
+
+    >>> class Post(Model):
+    ...     id = StringField(primary_key=True)
+    ...     email = StringField()
+    ...     content = TextField()
+    ...     created_at = FloatField()
+    >>> q = Post.query().filter(email='a@b.org', created_at__gt=0).order_by('-created_at').limit(20)
+    >>> q.sql()
+    ('select `id`,`email`,`created_at` from `post` where `created_at`>? and `email`=? order by `created_at` desc limit 20', [0, 'a@b.org'])
+    >>> q.only('email').sql('count')
+    ('select count(*) from (select 1 from `post` where `created_at`>? and `email`=? limit 20) t', [0, 'a@b.org'])
+    >>> Post.query().filter(id__in=['1', '2']).sql('exists')
+    ('select 1 from `post` where `id` in (?,?) limit 1', ['1', '2'])
+    >>> Post.query().filter(name='x')
+    Traceback (most recent call last):
+    ...
+    ValueError: Post has no field name
+    '''
+    def __init__(self,model):
+        self._model = model
+        self._where = []
+        self._args = []
+        self._order = []
+        self._limit = None
+        self._offset = None
+        self._columns = None
+        self._prefetch = ()
+        self._chunk_size = 1000
+    def _clone(self,**kw):
+        q = QuerySet(self._model)
+        q.__dict__.update(self.__dict__)
+        q._where = list(self._where)
+        q._args = list(self._args)
+        q.__dict__.update(kw)
+        return q
+    def _field(self,name):
+        if not name in self._model.__mappings__:
+            raise ValueError('%s has no field %s' % (self._model.__name__,name))
+        return name
+    def filter(self,**kw):
+        '''
+        Add field=value conditions (in keyword order), a field may end
+        with __ne, __gt, __gte, __lt, __lte or __in.
+        '''
+        q = self._clone()
+        for key in sorted(kw):
+            value = kw[key]
+            name,_,op = key.partition('__')
+            self._field(name)
+            if op=='in':
+                value = list(value)
+                if not value:
+                    q._where.append('1=0')
+                    continue
+                q._where.append('`%s` in (%s)' % (name,','.join(['?'] * len(value))))
+                q._args.extend(value)
+                continue
+            if not op in _LOOKUPS and op:
+                raise ValueError('Bad lookup: %s' % key)
+            q._where.append('`%s`%s?' % (name,_LOOKUPS[op or 'eq']))
+            q._args.append(value)
+        return q
+    def where(self,sql,*args):
+        '''
+        Add a raw condition with ? placeholders.
+        '''
+        q = self._clone()
+        q._where.append('(%s)' % sql)
+        q._args.extend(args)
+        return q
+    def order_by(self,*fields):
+        '''
+        Order by fields, a '-' in front sorts descending.
+        '''
+        order = []
+        for f in fields:
+            if f.startswith('-'):
+                order.append('`%s` desc' % self._field(f[1:]))
+            else:
+                order.append('`%s`' % self._field(f))
+        return self._clone(_order=order)
+    def limit(self,n):
+        return self._clone(_limit=int(n))
+    def offset(self,n):
+        return self._clone(_offset=int(n))
+    def only(self,*fields):
+        '''
+        Select only these fields, as columns= in Model.find_by.
+        '''
+        return self._clone(_columns=[self._field(f) for f in fields])
+    def prefetch(self,*names):
+        '''
+        Prefetch relations for every chunk of results, see Model.prefetch.
+        '''
+        return self._clone(_prefetch=names)
+    def chunk_size(self,n):
+        return self._clone(_chunk_size=int(n))
+    def sql(self,kind='select'):
+        '''
+        Return (sql, args) for kind 'select', 'count', 'exists' or 'first'.
+        '''
+        where = ' where ' + ' and '.join(self._where) if self._where else ''
+        table = self._model.__table__
+        if kind=='exists':
+            return 'select 1 from `%s`%s limit 1' % (table,where),list(self._args)
+        tail = ''
+        if self._limit is not None or kind=='first':
+            tail = ' limit %d' % (1 if kind=='first' else self._limit)
+        if self._offset is not None:
+            if not tail:
+                tail = ' limit 18446744073709551615'
+            tail = '%s offset %d' % (tail,self._offset)
+        if kind=='count':
+            if tail:
+                return 'select count(*) from (select 1 from `%s`%s%s) t' % (table,where,tail),list(self._args)
+            return 'select count(*) from `%s`%s' % (table,where),list(self._args)
+        order = ' order by ' + ', '.join(self._order) if self._order else ''
+        return 'select %s from `%s`%s%s%s' % (self._model._columns(self._columns),table,where,order,tail),list(self._args)
+    def __iter__(self):
+        #the rows stream on a pooled connection of their own, prefetch and
+        #lazy loads run on the scope connection (one is opened for the loop
+        #if there is none). Inside a transaction the rows stream on the
+        #transaction's connection to see its writes, and the first prefetch
+        #reads the rest of the result into memory
+        sql,args = self.sql()
+        model = self._model
+        chunk = []
+        with db.connection():
+            for d in db.iter_select(sql,args,chunk_size=self._chunk_size):
+                chunk.append(model._hydrate(d))
+                if len(chunk) >= self._chunk_size:
+                    for m in model.prefetch(chunk,*self._prefetch):
+                        yield m
+                    chunk = []
+            for m in model.prefetch(chunk,*self._prefetch):
+                yield m
+    def all(self):
+        return list(self)
+    def first(self):
+        '''
+        Return the first model or None, fetched with LIMIT 1.
+        '''
+        sql,args = self.sql('first')
+        d = db.select_one(sql,args)
+        if d is None:
+            return None
+        m = self._model._load(d)
+        self._model.prefetch([m],*self._prefetch)
+        return m
+    def count(self):
+        '''
+        Return the number of matching rows from a COUNT(*) query.
+        '''
+        sql,args = self.sql('count')
+        return db.select_int(sql,args)
+    def exists(self):
+        '''
+        Return True if any row matches, from a SELECT 1 ... LIMIT 1 query.
+        '''
+        sql,args = self.sql('exists')
+        return db.select_one(sql,args) is not None
+
 if __name__=='__main__':
     import logging
     logging.basicConfig(format='%(levelname)s:%(message)s')
@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+'''
+Full text search: a tokenizer for mixed CJK and western text and an
+incremental inverted index ranked with BM25.
+
+    index = SearchIndex(dict(name=3, summary=2, content=1))
+    index.add(blog.id, blog)
+    index.search(u'数据库 mysql', 10) ==> [(blog_id, score), ...]
+
+The index lives in memory and is saved to and loaded from a compact
+file. Each process keeps its own copy: the post_* triggers of the
+models it indexes record every change in a ChangeLog, which applies it
+at once and logs the document id to the search_log table, and every
+process replays the changes the others logged. One process at a time
+saves the file.
+'''
+
+import os,re,sys,math,time,heapq,zlib,socket,struct,logging,threading,collections
+from array import array
+from itertools import izip
+from operator import itemgetter
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import db
+
+_CJK = u'\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+_RE_TOKEN = re.compile(u'([%s]+)|([^\\W_%s]+)' % (_CJK,_CJK), re.UNICODE)
+
+def tokenize(text):
+    '''
+    Split text into lower case tokens: words of letters and digits, and
+    overlapping bigrams for runs of CJK characters, which have no spaces
+    between words. A CJK run of one character is a token by itself.
+
+    >>> print ' '.join(tokenize('MySQL数据库 入门, v5.7')).encode('utf-8')
+    mysql 数据 据库 入门 v5 7
+    '''
+    if isinstance(text,str):
+        text = text.decode('utf-8','ignore')
+    tokens = []
+    for cjk,word in _RE_TOKEN.findall(text.lower()):
+        if word:
+            tokens.append(word)
+        elif len(cjk) == 1:
+            tokens.append(cjk)
+        else:
+            tokens.extend([cjk[i:i + 2] for i in xrange(len(cjk) - 1)])
+    return tokens
+
+#the header of an index file, followed by the zlib compressed sections
+_MAGIC = 'WBSI\x01'
+
+def _pack(a):
+    #arrays are written little endian whatever the platform
+    if sys.byteorder == 'big':
+        a = array(a.typecode,a)
+        a.byteswap()
+    return a.tostring()
+
+def _unpack(typecode,s):
+    a = array(typecode)
+    a.fromstring(s)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+class SearchIndex(object):
+    '''
+    An inverted index over some text fields of documents, with a weight
+    per field. Every term maps to the ascending numbers of the documents
+    holding it and its weighted frequency in each, in two arrays. A
+    document that is removed is only marked deleted until compact(), an
+    updated one is removed and added again. position is the id of the
+    last change log row applied to the index.
+
+    >>> index = SearchIndex(dict(name=3, content=1))
+    >>> index.add('a', dict(name='Python web', content='A blog in python'))
+    >>> index.add('b', dict(name=u'数据库', content='MySQL and python'))
+    >>> index.add('c', dict(name='MySQL tuning', content=u'索引和数据库'))
+    >>> [d for d,score in index.search('python')]
+    ['a', 'b']
+    >>> [d for d,score in index.search(u'数据库 mysql', 2)]
+    ['b', 'c']
+    >>> index.remove('a')
+    >>> index.search('web'), len(index)
+    ([], 2)
+    '''
+    def __init__(self,fields,k1=1.2,b=0.75):
+        self.fields = dict(fields)
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self._clear()
+    def _clear(self):
+        #document number ==> document id, None once removed
+        self._docs = []
+        #document id ==> document number
+        self._numbers = {}
+        #document number ==> weighted token count
+        self._lengths = array('I')
+        #term ==> [array of document numbers, array of frequencies]
+        self._postings = {}
+        self._total = 0
+        self.position = 0
+    def __len__(self):
+        return len(self._numbers)
+    def _terms(self,doc):
+        counts = collections.defaultdict(int)
+        for field,weight in self.fields.iteritems():
+            for token in tokenize(doc[field] or u''):
+                counts[token] += weight
+        return counts
+    def add(self,doc_id,doc):
+        '''
+        Index doc, anything with the fields as keys, under doc_id,
+        replacing what was indexed under doc_id before.
+        '''
+        counts = self._terms(doc)
+        with self._lock:
+            self._remove(doc_id)
+            n = len(self._docs)
+            self._docs.append(doc_id)
+            self._numbers[doc_id] = n
+            length = sum(counts.itervalues())
+            self._lengths.append(length)
+            self._total += length
+            postings = self._postings
+            for term,count in counts.iteritems():
+                p = postings.get(term)
+                if p is None:
+                    p = postings[term] = [array('I'),array('H')]
+                p[0].append(n)
+                p[1].append(count if count < 0xffff else 0xffff)
+    def remove(self,doc_id):
+        '''
+        Drop doc_id from the results, if indexed.
+        '''
+        with self._lock:
+            self._remove(doc_id)
+    def _remove(self,doc_id):
+        n = self._numbers.pop(doc_id,None)
+        if n is not None:
+            self._docs[n] = None
+            self._total -= self._lengths[n]
+    def search(self,query,k=10):
+        '''
+        Return the k best (doc_id, score) for the terms of query, best
+        first, by BM25. Documents match any of the terms.
+        '''
+        terms = set(tokenize(query))
+        with self._lock:
+            n = len(self._numbers)
+            if not n or not terms:
+                return []
+            docs,lengths = self._docs,self._lengths
+            k1 = self.k1
+            #k1 * (1 - b + b * length / avg) == norm + scale * length
+            norm = k1 * (1 - self.b)
+            scale = k1 * self.b * n / float(self._total or 1)
+            scores = collections.defaultdict(float)
+            for term in terms:
+                p = self._postings.get(term)
+                if p is None:
+                    continue
+                #removed documents still count in df until compact()
+                df = len(p[0])
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5)) * (k1 + 1)
+                for d,tf in izip(p[0],p[1]):
+                    if docs[d] is not None:
+                        scores[d] += idf * tf / (tf + norm + scale * lengths[d])
+            return [(docs[d],score) for d,score in heapq.nlargest(k,scores.iteritems(),key=itemgetter(1))]
+    def compact(self,ratio=0):
+        '''
+        Renumber the documents left, dropping the removed ones from the
+        postings, if more than ratio of the document numbers are removed
+        ones.
+
+        >>> index = SearchIndex(dict(name=1))
+        >>> for d in 'abcd':
+        ...     index.add(d, dict(name='python'))
+        >>> index.remove('a')
+        >>> index.compact(0.5); len(index._docs)
+        4
+        >>> index.compact(); len(index._docs)
+        3
+        '''
+        with self._lock:
+            dead = len(self._docs) - len(self._numbers)
+            if dead <= ratio * len(self._docs):
+                return
+            numbers = array('i',[-1]) * len(self._docs)
+            docs = []
+            lengths = array('I')
+            for n,doc_id in enumerate(self._docs):
+                if doc_id is not None:
+                    numbers[n] = len(docs)
+                    docs.append(doc_id)
+                    lengths.append(self._lengths[n])
+            postings = {}
+            for term,(ds,tfs) in self._postings.iteritems():
+                p = [array('I'),array('H')]
+                for d,tf in izip(ds,tfs):
+                    if numbers[d] >= 0:
+                        p[0].append(numbers[d])
+                        p[1].append(tf)
+                if p[0]:
+                    postings[term] = p
+            self._docs = docs
+            self._numbers = dict([(doc_id,n) for n,doc_id in enumerate(docs)])
+            self._lengths = lengths
+            self._postings = postings
+    def save(self,path):
+        '''
+        Write the index to path, compacted, replacing the file atomically.
+        The file holds the document ids, their lengths, the terms and
+        their postings as arrays of 32 bit document numbers and 16 bit
+        frequencies, all zlib compressed, then the position.
+        '''
+        with self._lock:
+            self.compact()
+            terms = sorted(self._postings)
+            sizes = array('I',[len(self._postings[t][0]) for t in terms])
+            ds = array('I')
+            tfs = array('H')
+            for t in terms:
+                ds.extend(self._postings[t][0])
+                tfs.extend(self._postings[t][1])
+            sections = ['\n'.join([unicode(d) for d in self._docs]).encode('utf-8'),_pack(self._lengths),
+                        '\n'.join(terms).encode('utf-8'),_pack(sizes),_pack(ds),_pack(tfs),
+                        struct.pack('<Q',self.position)]
+        body = zlib.compress(''.join([struct.pack('<I',len(x)) + x for x in sections]),6)
+        tmp = '%s.%d.tmp' % (path,os.getpid())
+        with open(tmp,'wb') as f:
+            f.write(_MAGIC)
+            f.write(body)
+        os.rename(tmp,path)
+    def load(self,path):
+        '''
+        Replace the index with the one saved at path. Return False if
+        there is no such file.
+        '''
+        if not os.path.exists(path):
+            return False
+        with open(path,'rb') as f:
+            data = f.read()
+        if not data.startswith(_MAGIC):
+            raise ValueError('not a search index: %s' % path)
+        body = zlib.decompress(buffer(data,len(_MAGIC)))
+        sections = []
+        pos = 0
+        while pos < len(body):
+            size, = struct.unpack_from('<I',body,pos)
+            sections.append(body[pos + 4:pos + 4 + size])
+            pos = pos + 4 + size
+        docs = sections[0].decode('utf-8').split(u'\n') if sections[0] else []
+        terms = sections[2].decode('utf-8').split(u'\n') if sections[2] else []
+        lengths,sizes = _unpack('I',sections[1]),_unpack('I',sections[3])
+        ds,tfs = _unpack('I',sections[4]),_unpack('H',sections[5])
+        postings = {}
+        start = 0
+        for term,size in izip(terms,sizes):
+            postings[term] = [ds[start:start + size],tfs[start:start + size]]
+            start = start + size
+        with self._lock:
+            self._docs = docs
+            self._numbers = dict([(doc_id,n) for n,doc_id in enumerate(docs)])
+            self._lengths = lengths
+            self._postings = postings
+            self._total = sum(lengths)
+            #files saved before the change log replay it all
+            self.position = struct.unpack('<Q',sections[6])[0] if len(sections) > 6 else 0
+        return True
+    def rebuild(self,docs):
+        '''
+        Replace the index with the (doc_id, doc) pairs of docs.
+        '''
+        with self._lock:
+            self._clear()
+            for doc_id,doc in docs:
+                self.add(doc_id,doc)
+
+#the table the changes of all indexes are logged to, see createtable.sql
+_LOG_TABLE = 'search_log'
+_HOST = socket.gethostname()
+
+def _origin():
+    #the process writing a log row, a forked child is another one
+    return '%s:%d' % (_HOST,os.getpid())
+
+class ChangeLog(object):
+    '''
+    Keep the copy of an index in every process current. record() applies
+    a change to the index of this process and logs the document id under
+    name, replay() applies the changes logged by the other processes since
+    the position of the index, reading each document again with
+    load(doc_id), None once it is deleted. Replaying a change twice does
+    no harm.
+
+    An id is taken when a row is inserted but the row only shows once
+    committed, so a lower id can show after a higher one was replayed:
+    replay() also reads the rows logged in the last window seconds and
+    applies the ones it has not seen.
+
+    Removed documents stay in the postings until the index is compacted,
+    which replay() does once more than max_dead of them are removed ones.
+
+    Changes are kept keep seconds, an index file older than that may have
+    missed some and is rebuilt rather than loaded.
+    '''
+    def __init__(self,name,index,load,keep=86400,max_dead=0.2,window=10):
+        self.name = name
+        self.index = index
+        self.load = load
+        self.keep = keep
+        self.max_dead = max_dead
+        self.window = window
+        #log row id ==> created_at, of the rows read inside the window
+        self._seen = {}
+        self._lock_file = None
+        self._lock_pid = None
+        #(pid, thread) of the follow() thread
+        self._follower = None
+        self._follow_lock = threading.Lock()
+    def record(self,doc_id,doc):
+        '''
+        Apply a committed change, doc is None for a deleted document.
+        '''
+        if doc is None:
+            self.index.remove(doc_id)
+        else:
+            self.index.add(doc_id,doc)
+        try:
+            db.insert(_LOG_TABLE,name=self.name,doc_id=doc_id,origin=_origin(),created_at=time.time())
+        except Exception:
+            logging.exception('log change of %s %s failed, other processes miss it until a rebuild' % (self.name,doc_id))
+    def replay(self,limit=1000):
+        '''
+        Apply at most limit logged changes past the position of the index,
+        and the ones of the window before it not seen yet, return how many
+        were read. The changes this process logged were applied by
+        record() and are skipped.
+        '''
+        since = time.time() - self.window
+        columns = '`id`,`doc_id`,`origin`,`created_at`'
+        rows = db.select('select %s from `%s` where `name`=? and `id`>? order by `id` limit %d' % (columns,_LOG_TABLE,limit),
+                         [self.name,self.index.position],cache=False,primary=True)
+        late = db.select('select %s from `%s` where `name`=? and `id`<=? and `created_at`>?' % (columns,_LOG_TABLE),
+                         [self.name,self.index.position,since],cache=False,primary=True)
+        seen = self._seen
+        for i,t in seen.items():
+            if t <= since:
+                del seen[i]
+        rows = [r for r in late if not r.id in seen] + rows
+        if not rows:
+            self.index.compact(self.max_dead)
+            return 0
+        origin = _origin()
+        docs = {}
+        for r in rows:
+            if r.created_at > since:
+                seen[r.id] = r.created_at
+            if r.origin != origin and not r.doc_id in docs:
+                docs[r.doc_id] = self.load(r.doc_id)
+        with self.index._lock:
+            for doc_id,doc in docs.iteritems():
+                if doc is None:
+                    self.index.remove(doc_id)
+                else:
+                    self.index.add(doc_id,doc)
+            self.index.position = max(self.index.position,rows[-1].id)
+            self.index.compact(self.max_dead)
+        return len(rows)
+    def open(self,path,docs):
+        '''
+        Load the index from path, or rebuild it from the (doc_id, doc)
+        pairs docs() returns if there is no file or it is too old, then
+        replay the changes since.
+        '''
+        with db.connection():
+            fresh = os.path.exists(path) and time.time() - os.path.getmtime(path) < self.keep
+            if not (fresh and self.index.load(path)):
+                #changes logged during the rebuild are replayed after it
+                position = db.select_int('select ifnull(max(`id`),0) from `%s`' % _LOG_TABLE,cache=False,primary=True)
+                self.index.rebuild(docs())
+                self.index.position = position
+            while self.replay():
+                pass
+    def _owner(self,path):
+        #the process holding the lock file saves the index, the lock goes with the process
+        if fcntl is None:
+            return True
+        if self._lock_file is not None and self._lock_pid != os.getpid():
+            #a forked child shares the lock of its parent, closing its copy leaves it held
+            self._lock_file.close()
+            self._lock_file = None
+        if self._lock_file is None:
+            f = open(path + '.lock','a')
+            try:
+                fcntl.flock(f.fileno(),fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                f.close()
+                return False
+            self._lock_file = f
+            self._lock_pid = os.getpid()
+        return True
+    def follow(self,path,seconds=5,save_seconds=60):
+        '''
+        Start a daemon thread replaying the log every seconds and return
+        it. The one process owning path also saves the index there every
+        save_seconds if it changed and drops the changes older than keep.
+
+        Threads do not survive a fork: call follow() again in the forked
+        process, it returns the running thread unless the process changed
+        since it was started.
+        '''
+        pid = os.getpid()
+        follower = self._follower
+        if follower is not None and follower[0] == pid:
+            return follower[1]
+        def run():
+            saved = self.index.position
+            last_save = time.time()
+            while True:
+                time.sleep(seconds)
+                try:
+                    with db.connection():
+                        while self.replay():
+                            pass
+                        if time.time() - last_save < save_seconds or not self._owner(path):
+                            continue
+                        last_save = time.time()
+                        db.update('delete from `%s` where `created_at`<?' % _LOG_TABLE,time.time() - self.keep)
+                    if self.index.position != saved:
+                        saved = self.index.position
+                        self.index.save(path)
+                except Exception:
+                    logging.exception('follow search log failed')
+        with self._follow_lock:
+            follower = self._follower
+            if follower is None or follower[0] != pid:
+                t = threading.Thread(target=run,name='follow-search-log')
+                t.daemon = True
+                t.start()
+                follower = self._follower = (pid,t)
+        return follower[1]
+
+#the posts, kept current by the Blog triggers through blogs_log
+blogs = SearchIndex(dict(name=3,summary=2,content=1))
+blogs_log = ChangeLog('blogs',blogs,lambda doc_id: db.select_one('select * from `blogs` where `id`=?',[doc_id],cache=False,primary=True))
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -5,7 +5,8 @@ import logging
 logging.basicConfig(format='%(levelname)s:%(message)s',level='INFO')
 import threading
 from datetime import datetime, timedelta, tzinfo,date
-import os, re, cgi, urllib, functools, types, sys, traceback
+import os, re, cgi, urllib, functools, types, sys, traceback, mimetypes, mmap, time, collections
+from email.utils import formatdate, parsedate_tz, mktime_tz
 try:
     from cStringIO import StringIO
 except ImportError:
@@ -304,6 +305,94 @@ def notfound():
     '''
     return HttpError(404)
 
+def notmodified():
+    '''
+    Send a not modified response, without a body.
+    >>> raise notmodified()
+    Traceback (most recent call last):
+      ...
+    HttpError: 304 Not Modified
+    '''
+    return HttpError(304)
+
+def _http_date(t):
+    '''
+    Format a timestamp or a datetime as an HTTP date.
+
+    >>> _http_date(1420070400.5)
+    'Thu, 01 Jan 2015 00:00:00 GMT'
+    '''
+    if isinstance(t, datetime):
+        t = time.mktime(t.timetuple()) if t.tzinfo is None else (t - datetime(1970, 1, 1, tzinfo=UTC('+00:00'))).total_seconds()
+    return formatdate(int(t), usegmt=True)
+
+def _etag(value, weak=True):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    value = str(value)
+    if value.startswith('"') or value.startswith('W/"'):
+        return value
+    return '%s"%s"' % ('W/' if weak else '', value.replace('"', ''))
+
+def check_modified(etag=None, last_modified=None, weak=True):
+    '''
+    Set the ETag and/or Last-Modified headers of the response and raise
+    304 Not Modified if the request's If-None-Match or If-Modified-Since
+    says the client has it already. Call it in a handler before doing the
+    work of the response, the template is then not rendered at all:
+
+    @view('blog.html')
+    @get('/blog/:id')
+    def blog(id):
+        b = Blog.get(id)
+        check_modified(etag=b.version, last_modified=b.created_at)
+        return dict(blog=b, comments=b.comments)
+
+    etag is any value, quoted as a weak validator unless weak=False;
+    last_modified is a timestamp or a datetime. Only GET and HEAD
+    requests are answered with 304.
+
+    >>> ctx.request = Request({'REQUEST_METHOD': 'GET', 'HTTP_IF_NONE_MATCH': 'W/"3"'})
+    >>> ctx.response = Response()
+    >>> check_modified(etag=3)
+    Traceback (most recent call last):
+      ...
+    HttpError: 304 Not Modified
+    >>> check_modified(etag=4)
+    >>> ctx.response.header('ETag')
+    'W/"4"'
+    >>> ctx.request = Request({'REQUEST_METHOD': 'GET', 'HTTP_IF_MODIFIED_SINCE': 'Thu, 01 Jan 2015 00:00:00 GMT'})
+    >>> check_modified(last_modified=1420070400.5)
+    Traceback (most recent call last):
+      ...
+    HttpError: 304 Not Modified
+    >>> check_modified(last_modified=1420070401)
+    >>> del ctx.request, ctx.response
+    '''
+    response = ctx.response
+    if etag is not None:
+        etag = _etag(etag, weak)
+        response.set_header('ETag', etag)
+    if last_modified is not None:
+        last_modified = _http_date(last_modified)
+        response.set_header('Last-Modified', last_modified)
+    request = ctx.request
+    if not request.request_method in ('GET', 'HEAD'):
+        return
+    if_none_match = request.header('If-None-Match')
+    if if_none_match is not None:
+        #If-None-Match wins over If-Modified-Since, and compares weakly
+        if etag is not None:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            if '*' in tags or etag.replace('W/', '', 1) in [t.replace('W/', '', 1) for t in tags]:
+                raise notmodified()
+        return
+    if_modified_since = request.header('If-Modified-Since')
+    if if_modified_since is not None and last_modified is not None:
+        since = parsedate_tz(if_modified_since.split(';')[0])
+        if since is not None and mktime_tz(parsedate_tz(last_modified)) <= mktime_tz(since):
+            raise notmodified()
+
 def conflict():
     '''
     Send a conflict response.
@@ -404,6 +493,16 @@ def _unquote(s, encoding='utf-8'):
     '''
     return urllib.unquote(s).decode(encoding)
 
+#the methods a handler can be routed for
+_METHODS = ('GET', 'POST', 'PUT', 'DELETE', 'HEAD')
+
+def _route_decorator(method, path):
+    def _decorator(func):
+        func.__web_route__ = path
+        func.__web_method__ = method
+        return func
+    return _decorator
+
 def get(path):
     '''
     A @get decorator.
@@ -421,11 +520,7 @@ def get(path):
     >>> test()
     'ok'
     '''
-    def _decorator(func):
-        func.__web_route__ = path
-        func.__web_method__ = 'GET'
-        return func
-    return _decorator
+    return _route_decorator('GET', path)
 
 def post(path):
     '''
@@ -441,11 +536,44 @@ def post(path):
     >>> testpost()
     '200'
     '''
-    def _decorator(func):
-        func.__web_route__ = path
-        func.__web_method__ = 'POST'
-        return func
-    return _decorator
+    return _route_decorator('POST', path)
+
+def put(path):
+    '''
+    A @put decorator.
+    >>> @put('/blog/:id')
+    ... def testput(id):
+    ...     return id
+    ...
+    >>> testput.__web_method__
+    'PUT'
+    '''
+    return _route_decorator('PUT', path)
+
+def delete(path):
+    '''
+    A @delete decorator.
+    >>> @delete('/blog/:id')
+    ... def testdelete(id):
+    ...     return id
+    ...
+    >>> testdelete.__web_method__
+    'DELETE'
+    '''
+    return _route_decorator('DELETE', path)
+
+def head(path):
+    '''
+    A @head decorator. HEAD requests of paths without one are handled by
+    the @get handler.
+    >>> @head('/blog/:id')
+    ... def testhead(id):
+    ...     return id
+    ...
+    >>> testhead.__web_method__
+    'HEAD'
+    '''
+    return _route_decorator('HEAD', path)
 
 #分割路径的正则表达式，注意括号中的内容不会被剔除，而是放入一个组中
 _RE_ROUTE = re.compile(r'(\:[a-zA-Z_]\w*)')
@@ -486,6 +614,8 @@ class Route(object):
     def __init__(self, func):
         self.path = func.__web_route__
         self.method = func.__web_method__
+        if not self.method in _METHODS:
+            raise ValueError('Bad method %s of route %s' % (self.method, self.path))
         #如果有则为假，如果没有则为真
         self.is_static = _RE_ROUTE.search(self.path) is None
         #如果有如果是post
@@ -505,17 +635,238 @@ class Route(object):
             return 'Route(static,%s,path=%s)' % (self.method,self.path)
         return 'Route(dynamic,%s,path=%s)' % (self.method,self.path)
         
-def _static_file_generator(fpath):
-    BLOCK_SIZE = 8192
-    with open(fpath,'rb') as f:
-        block = f.read(BLOCK_SIZE)
-        while block:
-            yield block
-            block = f.read(BLOCK_SIZE)
+class _Node(object):
+    '''
+    A node of the route tree, for one path segment.
+    '''
+    __slots__ = ('children', 'params', 'patterns', 'rest', 'routes')
+    def __init__(self):
+        #literal segment ==> node
+        self.children = {}
+        #':name' segments, the values are passed to the handler
+        self.params = None
+        #(regex, node) for segments mixing text and parameters like ':id-:pid'
+        self.patterns = []
+        #method ==> route of a trailing '*name', matching the rest of the path
+        self.rest = None
+        #method ==> route ending here
+        self.routes = None
+
+class _Router(object):
+    '''
+    Route paths through a tree with a node per path segment, so a match
+    costs one dict lookup per segment whatever the number of routes; paths
+    without parameters are a single dict lookup. Literal segments are
+    tried before parameters. A path matching a route
+    of another method only gets the methods it supports.
+
+    >>> r = _Router()
+    >>> for path in ('/blog/:id', '/blog/new', '/blog/:id/comments', '/:id-:pid/:w', '/static/*file'):
+    ...     r.add(Dict(path=path, method='GET'))
+    >>> r.add(Dict(path='/blog/:id', method='DELETE'))
+    >>> routes, args = r.match('/blog/123')
+    >>> sorted(routes), args
+    (['DELETE', 'GET'], ['123'])
+    >>> r.match('/blog/new', 'DELETE')[1]
+    ['new']
+    >>> r.match('/blog/new')[0]['GET'].path, r.match('/blog/new')[1]
+    ('/blog/new', [])
+    >>> r.match('/blog/1/comments')[1]
+    ['1']
+    >>> r.match('/a-b/c')[1]
+    ['a', 'b', 'c']
+    >>> r.match('/static/css/a.css')[1]
+    ['css/a.css']
+    >>> r.match('/blog') is None, r.match('/blog/1/x') is None
+    (True, True)
+    '''
+    def __init__(self):
+        self._root = _Node()
+        #path without parameters ==> method ==> route, looked up first
+        self._static = {}
+    def add(self, route):
+        if not _RE_ROUTE.search(route.path) and not '/*' in route.path:
+            self._put(self._static.setdefault(route.path, {}), route)
+            return
+        node = self._root
+        segments = route.path.split('/')
+        for i, seg in enumerate(segments):
+            if seg.startswith('*') and i == len(segments) - 1:
+                if node.rest is None:
+                    node.rest = {}
+                self._put(node.rest, route)
+                return
+            if seg.startswith(':') and _RE_ROUTE.match(seg).group(0) == seg:
+                if node.params is None:
+                    node.params = _Node()
+                node = node.params
+            elif _RE_ROUTE.search(seg):
+                regex = _build_regex(seg)
+                for r, child in node.patterns:
+                    if r.pattern == regex:
+                        node = child
+                        break
+                else:
+                    child = _Node()
+                    node.patterns.append((re.compile(regex), child))
+                    node = child
+            else:
+                node = node.children.setdefault(seg, _Node())
+        if node.routes is None:
+            node.routes = {}
+        self._put(node.routes, route)
+    def _put(self, routes, route):
+        if route.method in routes:
+            raise ValueError('Duplicate route: %s %s' % (route.method, route.path))
+        routes[route.method] = route
+    def match(self, path, method='GET'):
+        '''
+        Return (method ==> route, args) of the route matching path, one
+        having method if any, or None.
+        '''
+        static = self._static.get(path)
+        if static is not None and method in static:
+            return static, []
+        args = []
+        routes = self._match(self._root, path.split('/'), 0, args)
+        if static is not None and (routes is None or not method in routes):
+            return static, []
+        return None if routes is None else (routes, args)
+    def _match(self, node, segments, i, args):
+        if i == len(segments):
+            return node.routes
+        seg = segments[i]
+        child = node.children.get(seg)
+        if child is not None:
+            r = self._match(child, segments, i + 1, args)
+            if r is not None:
+                return r
+        if not seg:
+            #parameters are never empty, like [^\/]+ in _build_regex
+            return None
+        for regex, child in node.patterns:
+            m = regex.match(seg)
+            if m is not None:
+                n = len(args)
+                args.extend(m.groups())
+                r = self._match(child, segments, i + 1, args)
+                if r is not None:
+                    return r
+                del args[n:]
+        if node.params is not None:
+            args.append(seg)
+            r = self._match(node.params, segments, i + 1, args)
+            if r is not None:
+                return r
+            args.pop()
+        if node.rest is not None:
+            args.append('/'.join(segments[i:]))
+            return node.rest
+        return None
+
+_STATIC_BLOCK_SIZE = 256 * 1024
+
+def _static_file_generator(fpath, ranges=None):
+    '''
+    Yield the bytes of fpath, or of the (first, last) byte ranges of it,
+    as slices of an mmap of the file so they are never read() through
+    Python buffers.
+    '''
+    with open(fpath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for part in ranges or [(0, size - 1)]:
+                if isinstance(part, str):
+                    yield part
+                    continue
+                pos, end = part[0], part[1] + 1
+                while pos < end:
+                    yield m[pos:min(pos + _STATIC_BLOCK_SIZE, end)]
+                    pos = pos + _STATIC_BLOCK_SIZE
+        finally:
+            m.close()
+
+_RE_RANGE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+#more ranges in one Range header than this get the whole file
+_MAX_RANGES = 16
+
+def _parse_range(header, size):
+    '''
+    Parse a Range header into a list of (first, last) byte positions in a
+    file of size bytes, sorted, with overlapping and adjacent ranges
+    merged. Return None to ignore the header and send the whole file, or
+    [] if no range can be satisfied. A header of more than _MAX_RANGES
+    ranges, or of ranges adding up to more than the file, is ignored so
+    it cannot make the response larger than the file (CVE-2011-3192).
+
+    >>> _parse_range('bytes=0-99', 1000)
+    [(0, 99)]
+    >>> _parse_range('bytes=-100, 900-, 10-20, 21-30', 1000)
+    [(10, 30), (900, 999)]
+    >>> _parse_range('bytes=500-2000', 1000)
+    [(500, 999)]
+    >>> _parse_range('bytes=1000-', 1000)
+    []
+    >>> _parse_range('bytes=5-1', 1000) is None, _parse_range('items=1-2', 1000) is None
+    (True, True)
+    >>> _parse_range('bytes=0-,1-,2-', 1000) is None, _parse_range('bytes=' + ','.join(['%d-%d' % (i, i) for i in range(0, 100, 2)]), 1000) is None
+    (True, True)
+    '''
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    items = spec.split(',')
+    if len(items) > _MAX_RANGES:
+        return None
+    ranges = []
+    total = 0
+    for item in items:
+        m = _RE_RANGE.match(item)
+        if m is None or m.groups() == ('', ''):
+            return None
+        first, last = m.groups()
+        if not first:
+            #a suffix: the last bytes of the file
+            n = int(last)
+            if not (n and size):
+                continue
+            first, last = max(size - n, 0), size - 1
+        else:
+            first = int(first)
+            if last and int(last) < first:
+                return None
+            if first >= size:
+                continue
+            last = min(int(last), size - 1) if last else size - 1
+        ranges.append((first, last))
+        total = total + last - first + 1
+    if total > size:
+        return None
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
 
 class StaticFileRoute(object):
+    '''
+    Serve the files under document_root/static. Whole files go through the
+    server's wsgi.file_wrapper when it has one, which may use sendfile(),
+    and otherwise through an mmap. Range requests get 206 with one range
+    or a multipart/byteranges body, or 416 if none can be satisfied. The
+    ranges are merged first, and headers asking for too many ranges or
+    more bytes than the file get 200 with the whole file. Files carry a
+    weak ETag of their mtime and size and Last-Modified, and conditional
+    requests for unchanged files get 304.
+    '''
     def __init__(self):
         self.method = 'GET'
+        self.path = '/static/*file'
         self.is_static = False
         self.route = re.compile('^/static/(.+)$')
     def match(self,url):
@@ -523,13 +874,55 @@ class StaticFileRoute(object):
             return (url[1:],)
         return None
     def __call__(self, *args):
-        fpath = os.path.join(ctx.application.document_root, args[0])
-        if not os.path.isfile(fpath):
+        root = os.path.join(ctx.application.document_root, 'static')
+        fpath = os.path.normpath(os.path.join(root, args[0]))
+        if not fpath.startswith(os.path.join(root, '')) or not os.path.isfile(fpath):
             raise notfound()
         fext = os.path.splitext(fpath)[1]
         #mimetypes.types_map是一个dict所以可以用get方法获取，当获取不到时默认为‘application/octet-stream’类型
-        ctx.response.content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
-        return _static_file_generator(fpath)
+        content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
+        st = os.stat(fpath)
+        size = st.st_size
+        response = ctx.response
+        response.set_header('Accept-Ranges', 'bytes')
+        check_modified(etag='%x-%x' % (int(st.st_mtime), size), last_modified=st.st_mtime)
+        header = ctx.request.header('Range')
+        ranges = _parse_range(header, size) if header else None
+        if_range = ctx.request.header('If-Range')
+        if ranges is not None and if_range is not None and if_range != response.header('Last-Modified'):
+            #the client's copy is stale, or validated by our weak ETag which If-Range can't use
+            ranges = None
+        if ranges is None:
+            response.content_type = content_type
+            response.content_length = size
+            file_wrapper = ctx.request.environ.get('wsgi.file_wrapper')
+            if file_wrapper is not None:
+                return file_wrapper(open(fpath, 'rb'), _STATIC_BLOCK_SIZE)
+            return _static_file_generator(fpath)
+        if not ranges:
+            response.set_header('Content-Range', 'bytes */%d' % size)
+            raise HttpError(416)
+        response.status = 206
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            response.content_type = content_type
+            response.set_header('Content-Range', 'bytes %d-%d/%d' % (first, last, size))
+            response.content_length = last - first + 1
+            return _static_file_generator(fpath, ranges)
+        #multipart/byteranges: a header before each range, a closing boundary at the end
+        boundary = os.urandom(12).encode('hex')
+        parts = []
+        length = 0
+        for first, last in ranges:
+            head = '\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (boundary, content_type, first, last, size)
+            parts.append(head)
+            parts.append((first, last))
+            length = length + len(head) + last - first + 1
+        parts.append('\r\n--%s--\r\n' % boundary)
+        length = length + len(parts[-1])
+        response.content_type = 'multipart/byteranges; boundary=%s' % boundary
+        response.content_length = length
+        return _static_file_generator(fpath, parts)
 
 ###################################################################################################
 def favicon_handler():
@@ -1226,7 +1619,8 @@ def view(path):
         @functools.wraps(func)
         def _wrapper(*args, **kw):
             r = func(*args, **kw)
-            if isinstance(r, dict):
+            #rows of db selects are mappings but not dicts
+            if isinstance(r, collections.Mapping):
                 logging.info('Return : Template')
                 return Template(path, **r)
             raise ValueError('Expect return a dict when using @view() decorator.')
@@ -1365,11 +1759,7 @@ class WSGIApplication(object):
         self._interceptors = []
         self._template_engine = None
 
-        self._get_static = {}
-        self._post_static = {}
-
-        self._get_dynamic = []
-        self._post_dynamic = []
+        self._router = _Router()
 
     def _check_not_running(self):
         if self._running:
@@ -1399,16 +1789,7 @@ class WSGIApplication(object):
     def add_url(self, func):
         self._check_not_running()
         route = Route(func)
-        if route.is_static:
-            if route.method=='GET':
-                self._get_static[route.path] = route
-            if route.method=='POST':
-                self._post_static[route.path] = route
-        else:
-            if route.method=='GET':
-                self._get_dynamic.append(route)
-            if route.method=='POST':
-                self._post_dynamic.append(route)
+        self._router.add(route)
         logging.info('Add route: %s' % str(route))
 
     def add_interceptor(self, func):
@@ -1426,42 +1807,27 @@ class WSGIApplication(object):
         self._check_not_running()
         #如果是调试模式
         if debug:
-            self._get_dynamic.append(StaticFileRoute())
+            self._router.add(StaticFileRoute())
         self._running = True
 
         _application = Dict(document_root=self._document_root)
-       #return html
+        #return html
         def fn_route():
             request_method = ctx.request.request_method
-            path_info = ctx.request.path_info
-            if request_method=='GET':
-                #return route with path_info
-                #fn is Route object
-                fn = self._get_static.get(path_info, None)
-                print self._get_static
-                print path_info
-                #if path_info is static
-                #route(fn) is callable
-                if fn:
-                    #fn.func() is the url maping function calls results
-                    return fn()
-                # if path_info is dynamic, finding the route in self._get_dynamic which mach the path_info
-                # fn is a Route object with match function path_info is dynamic so fn's path is regular
-                for fn in self._get_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise notfound()
-            if request_method=='POST':
-                fn = self._post_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._post_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
+            m = self._router.match(ctx.request.path_info, 'GET' if request_method=='HEAD' else request_method)
+            if m is None:
                 raise notfound()
-            raise badrequest()
+            routes, args = m
+            fn = routes.get(request_method)
+            if fn is None and request_method=='HEAD':
+                fn = routes.get('GET')
+            if fn is None:
+                allow = set(routes)
+                if 'GET' in allow:
+                    allow.add('HEAD')
+                ctx.response.set_header('Allow', ', '.join(sorted(allow)))
+                raise HttpError(405)
+            return fn(*args)
         #创建拦截器链
         fn_exec = _build_interceptor_chain(fn_route, *self._interceptors)
 
@@ -1471,6 +1837,12 @@ class WSGIApplication(object):
             response = ctx.response = Response()
             try:
                 r = fn_exec()
+                if ctx.request.request_method=='HEAD':
+                    #headers only: skip the render and release any file being served
+                    if hasattr(r, 'close'):
+                        r.close()
+                    start_response(response.status, response.headers)
+                    return []
                 if isinstance(r, Template):
                     #获取模板，并且render(r.name)
                     r = self._template_engine(r.template_name, r.model)
@@ -1486,6 +1858,12 @@ class WSGIApplication(object):
                 start_response(e.status, response.headers)
                 return []
             except HttpError, e:
+                if e.status.startswith('304') or ctx.request.request_method=='HEAD':
+                    #304 and HEAD responses never have a body
+                    response.unset_header('Content-Type')
+                    response.unset_header('Content-Length')
+                    start_response(e.status, response.headers)
+                    return []
                 start_response(e.status, response.headers)
                 return ['<html><body><h1>', e.status, '</h1></body></html>']
             except Exception, e:
@@ -1,11 +1,21 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 
-from src.web import get,view
+from src.web import get,view,ctx
+from src import search
 from src.model import User, Blog, Comment
 
 @view('test_users.html')
 @get('/')
 def test_users():
     users = User.find_all()
-    return dict(users=users)
\ No newline at end of file
+    return dict(users=users)
+
+@view('search.html')
+@get('/search')
+def search_blogs():
+    q = ctx.request.get('q', '').strip()
+    hits = search.blogs.search(q, 20) if q else []
+    found = dict([(b.id, b) for b in Blog.query().filter(id__in=[d for d, score in hits])])
+    blogs = [found[d] for d, score in hits if d in found]
+    return dict(q=q, blogs=blogs)
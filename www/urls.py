@@ -4,8 +4,8 @@ import logging
 logging.basicConfig(format='%(levelname)s:%(message)s',level='INFO')
 import os
 
-from src import db
-from src.web import WSGIApplication, Jinja2TemplateEngine
+from src import db, orm
+from src.web import WSGIApplication, Jinja2TemplateEngine, interceptor
 
 from config import configs
 
@@ -18,10 +18,34 @@ wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
 template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
 wsgi.template_engine = template_engine
 
+# 每个请求共用一个数据库连接作用域, 写之后的读会留在主库:
+@interceptor('/')
+def db_scope(next):
+    with db.connection():
+        return next()
+wsgi.add_interceptor(db_scope)
+
+# 加载博客的全文索引, 没有索引文件或文件太旧时从数据库重建, 再重放search_log里的修改;
+# 之后每5秒重放其他进程的修改, 持有锁文件的那个进程每分钟保存一次:
+from src import search
+from src.model import Blog
+search_index = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'search.idx')
+search.blogs_log.open(search_index, lambda: ((b.id, b) for b in Blog.iter_by('1=1', columns='*')))
+search.blogs_log.follow(search_index, 5, 60)
+
+# 线程不会跟着fork到子进程里, 多进程部署时每个worker在请求到来时启动自己的跟随线程:
+@interceptor('/')
+def search_follow(next):
+    search.blogs_log.follow(search_index, 5, 60)
+    return next()
+wsgi.add_interceptor(search_follow)
+
 # 加载带有@get/@post的URL处理函数:
 import test_web
 wsgi.add_module(test_web)
 
 # 在9000端口上启动本地测试服务器:
 if __name__ == '__main__':
+    # 开发模式下检查find_by/find_first的where条件有没有索引:
+    orm.check_indexes()
     wsgi.run(9000)